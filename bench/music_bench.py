@@ -0,0 +1,528 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from datetime import datetime
+
+# Offline benchmark for the Music cog: no Discord, no YouTube, no network.
+#
+#     python bench/music_bench.py --guilds 1,10,50,100,500 --output bench_results.json
+#
+# Every simulated guild joins a fake voice channel and issues !play for a few tracks.
+# A stand-in extractor replaces yt-dlp (with a configurable delay) and answers with
+# generated WAV files, a stand-in FFmpeg reads those files in 20 ms frames, and a fake
+# VoiceClient consumes the frames in real time on its own thread, like discord.py's
+# AudioPlayer. Pass --real-ffmpeg to decode the files with the real FFmpeg instead.
+#
+# Each guild count runs in a fresh child process so CPU and RSS aren't shared between
+# scales. The report (JSON) has enqueue throughput, time to first audio, the gap
+# between tracks and CPU/RSS per guild for every scale, so two runs can be diffed.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960 # 20 ms
+FRAME_SECONDS = FRAME_SAMPLES / SAMPLE_RATE
+
+def percentiles(values):
+    if not values:
+        return {'samples': 0}
+    values = sorted(values)
+    def pick(q):
+        return values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        'samples': len(values),
+        'avg': sum(values) / len(values),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'max': values[-1],
+    }
+
+def current_rss():
+    # Resident set size in bytes, or None where it can't be read cheaply
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+def generate_tracks(directory, count, seconds):
+    # Sine tones, one file per track variant, 48 kHz stereo s16le like Discord's PCM
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f'bench-{index}.wav')
+        frequency = 220 * (index + 1)
+        frames = bytearray()
+        for n in range(int(seconds * SAMPLE_RATE)):
+            sample = int(12000 * math.sin(2 * math.pi * frequency * n / SAMPLE_RATE))
+            frames += sample.to_bytes(2, 'little', signed=True) * CHANNELS
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(CHANNELS)
+            f.setsampwidth(2)
+            f.setframerate(SAMPLE_RATE)
+            f.writeframes(bytes(frames))
+        paths.append(path)
+    return paths
+
+# --- Stand-ins -------------------------------------------------------------
+
+def make_stand_in_ffmpeg(discord, startup_seconds):
+    class StandInFFmpeg(discord.AudioSource):
+        # Accepts FFmpegPCMAudio/FFmpegOpusAudio arguments and serves the WAV file in
+        # 20 ms frames. The first read waits `startup_seconds`, standing in for FFmpeg
+        # starting up and filling its pipe.
+        def __init__(self, source, *, before_options='', options='', **kwargs):
+            self._file = wave.open(source, 'rb')
+            start = 0.0
+            parts = before_options.split()
+            if '-ss' in parts:
+                start = float(parts[parts.index('-ss') + 1])
+            self._file.setpos(min(self._file.getnframes(), int(start * SAMPLE_RATE)))
+            self._started = False
+
+        def read(self):
+            if not self._started:
+                self._started = True
+                time.sleep(startup_seconds)
+            frame = self._file.readframes(FRAME_SAMPLES)
+            if len(frame) < FRAME_SAMPLES * CHANNELS * 2:
+                return b''
+            return frame
+
+        def is_opus(self):
+            return False
+
+        def cleanup(self):
+            self._file.close()
+
+    return StandInFFmpeg
+
+class StandInExtractor:
+    # Replaces ResolverPool._extract: runs on the resolver's threads like yt-dlp does,
+    # so the pool's scheduling is part of what is measured
+    def __init__(self, tracks, delay):
+        self.tracks = tracks
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, query, download):
+        self.calls += 1
+        time.sleep(self.delay)
+        # Queries look like bench://<guild>/<n>
+        number = int(query.rsplit('/', 1)[1])
+        path = self.tracks[number % len(self.tracks)]
+        with wave.open(path, 'rb') as f:
+            duration = f.getnframes() / f.getframerate()
+        return {
+            'id': query.replace('/', '_'),
+            'title': f'Bench track {query}',
+            'url': path,
+            'webpage_url': f'https://bench.invalid/{query}',
+            'uploader': 'bench',
+            'duration': duration,
+            'extractor': 'bench',
+            'acodec': 'pcm_s16le',
+        }
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        self.channel.edits += 1
+        return self
+
+class FakeTextChannel:
+    def __init__(self):
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+class FakeVoiceClient:
+    # Pulls frames from the source on a thread every 20 ms, like discord.py's AudioPlayer,
+    # and records when audio starts and stops for each track
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.timeline = [] # [play() called, first frame, last frame]
+        self.completed = 0
+        self.errors = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise RuntimeError('Already playing audio.')
+        self.source = source
+        self._stop = threading.Event()
+        self._end = threading.Event()
+        self._resumed.set()
+        entry = [time.perf_counter(), None, None]
+        self.timeline.append(entry)
+        self._thread = threading.Thread(target=self._run, args=(after, entry, self._end), daemon=True)
+        self._thread.start()
+
+    def _run(self, after, entry, end):
+        error = None
+        frames = 0
+        started = None
+        try:
+            while not self._stop.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    started = None
+                    continue
+                frame = self.source.read()
+                if not frame:
+                    break
+                now = time.perf_counter()
+                if entry[1] is None:
+                    entry[1] = now
+                entry[2] = now
+                if started is None:
+                    started, frames = now, 0
+                frames += 1
+                delay = started + frames * FRAME_SECONDS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+            self.errors += 1
+        finally:
+            self.source.cleanup()
+        # Like discord.py: no longer playing by the time `after` runs
+        end.set()
+        self.completed += 1
+        if after is not None:
+            after(error)
+
+    def is_playing(self):
+        return self._thread is not None and not self._end.is_set() and self._resumed.is_set()
+
+    def is_paused(self):
+        return self._thread is not None and not self._end.is_set() and not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._stop.set()
+        self._resumed.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id * 10
+        self.members = [] # the listener joins in FakeMember
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self)
+        self.text_channel = FakeTextChannel()
+
+    def get_channel(self, channel_id):
+        return self.voice_channel if channel_id == self.voice_channel.id else None
+
+class FakeAvatar:
+    url = 'https://bench.invalid/avatar.png'
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeMember:
+    def __init__(self, guild):
+        self.id = guild.id * 100
+        self.guild = guild
+        self.display_name = f'listener-{guild.id}'
+        self.display_avatar = FakeAvatar()
+        self.bot = False
+        self.voice = FakeVoiceState(guild.voice_channel)
+        guild.voice_channel.members.append(self)
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.author = FakeMember(guild)
+        self.channel = guild.text_channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return FakeTyping()
+
+class FakeBot:
+    def __init__(self, loop, guilds):
+        self.loop = loop
+        self.guilds = {guild.id: guild for guild in guilds}
+
+    @property
+    def voice_clients(self):
+        return [guild.voice_client for guild in self.guilds.values() if guild.voice_client is not None]
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    async def wait_until_ready(self):
+        return None
+
+# --- One scale, in a child process -----------------------------------------
+
+async def run_scale(args, tracks):
+    import discord
+    from cogs import music
+    from utils import data_client, metrics
+    from utils.ytdl_source import resolver
+
+    if not args.real_ffmpeg:
+        stand_in = make_stand_in_ffmpeg(discord, args.ffmpeg_startup_ms / 1000)
+        discord.FFmpegPCMAudio = stand_in
+        discord.FFmpegOpusAudio = stand_in
+    extractor = resolver._extract = StandInExtractor(tracks, args.resolve_ms / 1000)
+    # Play history goes nowhere: the database isn't part of this benchmark
+    music.add_history = lambda *a, **kw: None
+    data_client.close = lambda: None
+
+    loop = asyncio.get_running_loop()
+    guilds = [FakeGuild(guild_id) for guild_id in range(1, args.guilds + 1)]
+    bot = FakeBot(loop, guilds)
+    cog = music.Music(bot)
+    play = cog.play.callback
+
+    rss_baseline = current_rss()
+    rss_peak = rss_baseline
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    first_commands = {}
+    failures = []
+
+    async def sample_rss():
+        nonlocal rss_peak
+        while True:
+            rss = current_rss()
+            if rss is not None:
+                rss_peak = max(rss_peak or 0, rss)
+            await asyncio.sleep(0.25)
+
+    async def listener(guild):
+        ctx = FakeContext(guild)
+        for number in range(args.tracks):
+            if number == 0:
+                first_commands[guild.id] = time.perf_counter()
+            try:
+                await play(cog, ctx, query=f'bench://{guild.id}/{number}')
+            except Exception as e:
+                failures.append(repr(e))
+
+    sampler = loop.create_task(sample_rss())
+    await asyncio.gather(*(listener(guild) for guild in guilds))
+    enqueued_at = time.perf_counter()
+
+    # Wait for every guild to play through its queue
+    deadline = enqueued_at + args.tracks * args.track_seconds * 3 + 60
+    while time.perf_counter() < deadline:
+        if all(guild.voice_client and guild.voice_client.completed >= args.tracks for guild in guilds):
+            break
+        await asyncio.sleep(0.1)
+    finished_at = time.perf_counter()
+    sampler.cancel()
+    cpu_seconds = time.process_time() - cpu_started
+
+    first_audio = []
+    gaps = []
+    completed = 0
+    player_errors = 0
+    for guild in guilds:
+        vc = guild.voice_client
+        if vc is None:
+            continue
+        completed += vc.completed
+        player_errors += vc.errors
+        timeline = [entry for entry in vc.timeline if entry[1] is not None]
+        if timeline:
+            first_audio.append(timeline[0][1] - first_commands[guild.id])
+        for previous, following in zip(timeline, timeline[1:]):
+            gaps.append(following[1] - previous[2])
+
+    for guild in guilds:
+        if guild.voice_client is not None:
+            guild.voice_client.stop()
+    await cog.cog_unload()
+
+    commands = args.guilds * args.tracks
+    wall = finished_at - started
+    ms = lambda stats: {key: (value * 1000 if key != 'samples' else value) for key, value in stats.items()}
+    return {
+        'guilds': args.guilds,
+        'tracks_per_guild': args.tracks,
+        'enqueue': {
+            'commands': commands,
+            'seconds': enqueued_at - started,
+            'commands_per_second': commands / (enqueued_at - started),
+        },
+        'time_to_first_audio_ms': ms(percentiles(first_audio)),
+        'gap_ms': ms(percentiles(gaps)),
+        'tracks_completed': completed,
+        'tracks_expected': commands,
+        'command_failures': failures[:10],
+        'player_errors': player_errors,
+        'wall_seconds': wall,
+        'cpu': {
+            'seconds': cpu_seconds,
+            'percent_per_guild': cpu_seconds / wall / args.guilds * 100,
+        },
+        'rss': {
+            'baseline_mb': rss_baseline / 2 ** 20 if rss_baseline else None,
+            'peak_mb': rss_peak / 2 ** 20 if rss_peak else None,
+            'per_guild_kb': (rss_peak - rss_baseline) / 1024 / args.guilds if rss_baseline else None,
+        },
+        'resolver': {'calls': extractor.calls, **resolver.stats()},
+        'metrics': {
+            name: {'p50_ms': (histogram.quantile(0.5) or 0) * 1000, 'p95_ms': (histogram.quantile(0.95) or 0) * 1000, 'count': histogram.count}
+            for name, histogram in (
+                ('resolve', metrics.resolve_seconds),
+                ('player_start', metrics.player_start_seconds),
+                ('ffmpeg_first_frame', metrics.first_frame_seconds),
+                ('event_loop_lag', metrics.loop_lag),
+            )
+        },
+    }
+
+def child(args):
+    # State the cog would otherwise keep in instance/ goes to a scratch directory
+    scratch = tempfile.mkdtemp(prefix='music-bench-')
+    os.environ['METADATA_CACHE_PATH'] = os.path.join(scratch, 'metadata_cache.db')
+    os.environ['SNAPSHOT_PATH'] = os.path.join(scratch, 'playback_snapshot.json')
+    os.environ['AUDIO_CACHE_ENABLED'] = '0'
+    os.environ['LOUDNESS_WORKERS'] = '0'
+    os.environ.pop('DATA_SERVICE_AUTHKEY', None)
+    os.environ['WEB_MODE'] = 'embedded'
+    sys.path.insert(0, ROOT)
+    tracks = generate_tracks(scratch, args.variants, args.track_seconds)
+    result = asyncio.run(run_scale(args, tracks))
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Music cog')
+    parser.add_argument('--guilds', default='1,10,50,100,500', help='comma separated guild counts to simulate')
+    parser.add_argument('--tracks', type=int, default=3, help='!play commands per guild')
+    parser.add_argument('--track-seconds', type=float, default=3.0, help='length of the generated tracks')
+    parser.add_argument('--variants', type=int, default=4, help='number of distinct generated files')
+    parser.add_argument('--resolve-ms', type=float, default=100, help='stand-in extractor delay per lookup')
+    parser.add_argument('--ffmpeg-startup-ms', type=float, default=40, help='stand-in FFmpeg delay before the first frame')
+    parser.add_argument('--real-ffmpeg', action='store_true', help='decode with the real FFmpeg instead of the stand-in')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON report ("-" for stdout)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.guilds = int(args.guilds)
+        return child(args)
+
+    results = []
+    for guilds in [int(count) for count in args.guilds.split(',')]:
+        print(f'Benchmarking {guilds} guild(s)...', file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--guilds', str(guilds), '--result-file', result_file]
+        for option in ('tracks', 'track_seconds', 'variants', 'resolve_ms', 'ffmpeg_startup_ms'):
+            command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+        if args.real_ffmpeg:
+            command.append('--real-ffmpeg')
+        # The cog's own logging goes to the child's stdout; keep it out of the report
+        completed = subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+        try:
+            if completed.returncode != 0:
+                results.append({'guilds': guilds, 'error': f'exit code {completed.returncode}'})
+                continue
+            with open(result_file) as f:
+                result = json.load(f)
+            results.append(result)
+            print(
+                f"  {result['enqueue']['commands_per_second']:.1f} commands/s, "
+                f"first audio p95 {result['time_to_first_audio_ms'].get('p95', 0):.0f} ms, "
+                f"gap p95 {result['gap_ms'].get('p95', 0):.0f} ms, "
+                f"CPU {result['cpu']['percent_per_guild']:.2f}%/guild",
+                file=sys.stderr,
+            )
+        finally:
+            os.remove(result_file)
+
+    report = {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('child', 'result_file', 'output')},
+            'env': {key: os.environ[key] for key in ('PLAYBACK_MODE', 'PREFETCH_SECONDS', 'RESOLVER_WORKERS') if key in os.environ},
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,24 @@
+import time
+# Startup timing starts here, before the imports
+STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
 import os
 import asyncio
+import signal
+import threading
 from dotenv import load_dotenv
-from web_app import keep_alive
+from utils.data_client import DATA_SERVICE_ENABLED, WEB_MODE
+from utils.startup import StartupTimer, command_tree_hash, read_command_tree_hash, write_command_tree_hash
+from utils.resolver import load_yt_dlp
+from utils import metrics
+
+startup = StartupTimer(STARTED)
+metrics.registry.gauge(
+    'music_startup_seconds', 'Time spent in each phase of the last startup',
+    callback=lambda: {(name,): seconds for name, seconds in startup.phases}, labels=('phase',),
+)
 
 
 # Add FFmpeg to PATH temporarily for this session
@@ -14,27 +29,72 @@ if os.path.exists(ffmpeg_path):
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+# Set by launcher.py when the bot runs as several shard worker processes
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id]
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) or None
+startup.mark('imports')
 
-class MusicBot(commands.Bot):
+class MusicBot(commands.AutoShardedBot):
     def __init__(self):
         # We need voice states intent for the bot to know about voice channels
         intents = discord.Intents.default()
         intents.message_content = True
         # Disable default help command to use our custom one
-        super().__init__(command_prefix=commands.when_mentioned_or("!"), intents=intents, help_command=None)
+        super().__init__(
+            command_prefix=commands.when_mentioned_or("!"), intents=intents, help_command=None,
+            shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT,
+        )
 
     async def setup_hook(self):
+        startup.mark('login')
+        # SIGTERM (docker stop, dyno restarts, the launcher) would end the process without
+        # running atexit or cog_unload. Close the bot instead: unloading the cog flushes
+        # queued history and writes a last playback snapshot.
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: self.loop.create_task(self.close()))
+        except NotImplementedError:
+            pass # Windows has no loop signal handlers
         # Load the music cog
-        await self.load_extension('cogs.music')
+        with startup.phase('load cogs'):
+            await self.load_extension('cogs.music')
+        # The command tree is global: only the worker holding shard 0 syncs it
+        if SHARD_IDS and 0 not in SHARD_IDS:
+            return
+        with startup.phase('command sync'):
+            await self.sync_command_tree()
+
+    async def sync_command_tree(self):
         # Syncing commands globally
         # We clear the tree first to ensure no slash commands are registered
         self.tree.clear_commands(guild=None)
+        # Syncing is an API round-trip on every start; skip it while the tree is the same
+        # as last time. Deleting COMMAND_TREE_HASH_PATH forces a sync.
+        digest = command_tree_hash(self.tree, self.application_id)
+        if digest == read_command_tree_hash():
+            print("Command tree unchanged since the last sync, skipping it.")
+            return
         await self.tree.sync()
+        write_command_tree_hash(digest)
         print("Slash commands cleared/disabled. Only prefix commands are available.")
 
     async def on_ready(self):
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
+        print(f'Logged in as {self.user} (ID: {self.user.id}) on shards {sorted(self.shards)} of {self.shard_count}')
         print('------')
+        # on_ready fires again after reconnects; only the first one ends startup
+        if startup.total is None:
+            startup.mark('gateway connect')
+            print(startup.report())
+            # Load yt-dlp now, in the background, so the first !play doesn't wait for the import
+            self.loop.run_in_executor(None, load_yt_dlp)
+
+def start_web():
+    # Runs on its own thread: importing Flask and SQLAlchemy overlaps with logging in
+    if WEB_MODE == 'external':
+        from web_app import init_db
+        init_db()
+    else:
+        from web_app import run
+        run() # Start the web server
 
 bot = MusicBot()
 
@@ -44,7 +104,11 @@ if __name__ == '__main__':
         print("Please set your bot token in the .env file.")
     else:
         try:
-            keep_alive() # Start the web server
+            # In the sharded runtime the data service runs the web server instead,
+            # and with WEB_MODE=external it is a separate process (wsgi.py)
+            if not DATA_SERVICE_ENABLED:
+                # Daemon, so the process exits once the bot has closed
+                threading.Thread(target=start_web, name='web', daemon=True).start()
             bot.run(TOKEN)
         except discord.errors.LoginFailure:
             print("Failed to login: Invalid token.")
@@ -1,10 +1,22 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ui import Button, View
-from utils.ytdl_source import YTDLSource
-from web_app import add_history
+from utils.ytdl_source import Track, create_player, ffmpeg_count, resolver, DEFAULT_VOLUME
+from utils.spotify import spotify, is_spotify_url, SPOTIFY_LOOKAHEAD
+from utils.guild_queue import GuildQueue
+from utils.now_playing import NowPlayingPanel
+from utils.playlist import PlaylistImport, is_playlist_url
+from utils.snapshot import RestoredContext, read_snapshot, write_snapshot, restore_allowed, SNAPSHOT_INTERVAL, RESTORE_STAGGER
+from utils.audio_cache import audio_cache, AUDIO_CACHE_MIN_PLAYS, AUDIO_CACHE_WINDOW_DAYS, AUDIO_CACHE_HOT_TRACKS
+from utils.loop_buffer import loop_buffer
+from utils.loudness import loudness
+from utils.metadata_cache import metadata_cache
+from utils import data_client, metrics
+from utils.data_client import add_history, top_played, search_history, top_tracks, rebuild_rollups, upload_info, wait_db_ready
 import asyncio
 import os
+import time
+from datetime import datetime, timedelta
 
 
 # --- 🎨 CUSTOM EMOJI CONFIGURATION ---
@@ -20,6 +32,49 @@ EMOJI_LOOP = "↻"
 EMOJI_LIKE = "♡"
 EMOJI_LIKED = "💚" 
 
+# Seconds before the current track ends at which the next one is resolved and its FFmpeg pipeline started
+PREFETCH_SECONDS = int(os.getenv('PREFETCH_SECONDS', 15))
+QUEUE_PAGE_SIZE = 10
+TOP_TRACKS_MAX = 25
+# Minimum seconds between edits of a playlist import's progress message
+PLAYLIST_PROGRESS_INTERVAL = 3
+DB_READY_POLL = 5 # seconds per wait for the database at startup
+# The reaper leaves voice channels nobody is using and frees everything kept for the guild
+REAPER_INTERVAL = 30
+EMPTY_CHANNEL_TIMEOUT = int(os.getenv('EMPTY_CHANNEL_TIMEOUT', 60)) # seconds alone in the channel
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', 300)) # seconds with nothing playing or queued
+# FFmpeg processes one guild may run at once: the playing track plus the prefetched one.
+# Only optional work (prefetching) is held back at the limit, playback itself never is.
+GUILD_FFMPEG_LIMIT = int(os.getenv('GUILD_FFMPEG_LIMIT', 2))
+# Default jump for !forward and !rewind
+SEEK_STEP = 10
+# Songs in a row that may fail to start before play_next stops working through the queue
+MAX_START_FAILURES = 5
+
+def log_failure(future):
+    # For futures nobody awaits, whose exceptions would otherwise go unseen
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error after a track finished: {future.exception()!r}")
+
+def format_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def parse_time(text):
+    # "90", "1:30" or "1:02:03" -> seconds; None if it isn't a position
+    try:
+        parts = [float(part) for part in text.strip().split(':')]
+    except ValueError:
+        return None
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts):
+        return None
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
 class MusicControlView(View):
     def __init__(self, ctx, music_cog):
         super().__init__(timeout=None)
@@ -36,8 +91,10 @@ class MusicControlView(View):
         else:
             loop_btn.style = discord.ButtonStyle.secondary # Grey for disabled
 
-        # Update Play/Pause button based on voice state? 
-        pass
+        # Update Play/Pause button based on voice state
+        pause_btn = [x for x in self.children if x.custom_id == 'pause_resume'][0]
+        vc = self.ctx.guild.voice_client
+        pause_btn.label = EMOJI_PLAY if vc and vc.is_paused() else EMOJI_PAUSE
 
     @discord.ui.button(label=EMOJI_PAUSE, style=discord.ButtonStyle.success, custom_id='pause_resume') # Green Play/Pause button (Spotify style)
     async def pause_resume(self, interaction: discord.Interaction, button: Button):
@@ -64,29 +121,29 @@ class MusicControlView(View):
         
         vc = interaction.guild.voice_client
         if vc.is_playing() or vc.is_paused():
-            vc.stop() # This triggers the after_playing callback which plays the next song
-            await interaction.response.send_message(f"Skipped {EMOJI_SKIP}", ephemeral=True)
+            self.music_cog.stop_current(vc) # This triggers the after_playing callback which plays the next song
+            # No reply message: the now playing message itself switches to the next song
+            await interaction.response.defer()
         else:
             await interaction.response.send_message("Nothing is playing!", ephemeral=True)
 
+    # Not named stop: that would hide View.stop(), which releases the view
     @discord.ui.button(label=EMOJI_STOP, style=discord.ButtonStyle.secondary, custom_id='stop')
-    async def stop(self, interaction: discord.Interaction, button: Button):
+    async def stop_playback(self, interaction: discord.Interaction, button: Button):
         if not interaction.user.voice or not interaction.guild.voice_client:
              return await interaction.response.send_message("You need to be in a voice channel!", ephemeral=True)
         
         # Clear queue and stop
-        self.music_cog.queues[interaction.guild.id] = []
-        interaction.guild.voice_client.stop()
-        await interaction.response.send_message(f"Stopped {EMOJI_STOP}", ephemeral=True)
+        self.music_cog.clear_queue(interaction.guild.id)
+        self.music_cog.stop_current(interaction.guild.voice_client)
+        # The now playing message shows that the queue has finished
+        await interaction.response.defer()
 
     @discord.ui.button(label=EMOJI_LOOP, style=discord.ButtonStyle.secondary, custom_id='loop')
     async def loop(self, interaction: discord.Interaction, button: Button):
         guild_id = interaction.guild.id
-        if guild_id not in self.music_cog.loops:
-            self.music_cog.loops[guild_id] = False
-        
         # Toggle
-        self.music_cog.loops[guild_id] = not self.music_cog.loops[guild_id]
+        self.music_cog.set_loop(guild_id, not self.music_cog.loops.get(guild_id, False))
         
         # Update button style
         if self.music_cog.loops[guild_id]:
@@ -103,64 +160,596 @@ class MusicControlView(View):
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.queues = {} # guild_id -> list of YTDLSource objects
+        self.queues = {} # guild_id -> GuildQueue of Track objects
         self.loops = {} # guild_id -> bool
+        self.volumes = {} # guild_id -> float, 1.0 = 100%
+        self.current = {} # guild_id -> Track that is playing now
+        self.panels = {} # guild_id -> NowPlayingPanel, the one now playing message per guild
+        self.imports = {} # guild_id -> PlaylistImport still streaming entries into the queue
+        self.prefetched = {} # guild_id -> (Track, player) warmed up before its turn
+        self.prefetch_tasks = {} # guild_id -> asyncio.Task waiting to prefetch the next track
+        self.track_ended_at = {} # guild_id -> perf_counter() when the last track finished
+        self.idle_since = {} # guild_id -> monotonic() since when nothing is playing or queued
+        self.alone_since = {} # guild_id -> monotonic() since when no one else is in the voice channel
+        self.skipped = set() # guild_ids whose track was skipped or stopped, so loop mode doesn't replay it
+        self.play_locks = {} # guild_id -> asyncio.Lock, one play_next at a time per guild
+        if audio_cache.enabled:
+            self.refresh_audio_cache.start()
+        self.register_metrics()
+        self.lag_monitor = self.bot.loop.create_task(metrics.monitor_loop_lag())
+        # /metrics is served by another process: hand it our numbers through METRICS_DIR
+        if data_client.DATA_SERVICE_ENABLED or data_client.WEB_MODE == 'external':
+            self.publish_metrics.start()
+        # Snapshots start once the previous one has been restored
+        self.restore_task = self.bot.loop.create_task(self.restore_snapshot())
+        self.reap_idle.start()
+
+    async def cog_unload(self):
+        self.restore_task.cancel()
+        self.reap_idle.cancel()
+        self.lag_monitor.cancel()
+        self.publish_metrics.cancel()
+        for name in self.metric_names:
+            metrics.registry.unregister(name)
+        if self.save_snapshot.is_running():
+            self.save_snapshot.cancel()
+            # Last snapshot before going down, so a deploy resumes where it left off
+            write_snapshot(self.snapshot_state())
+        self.refresh_audio_cache.cancel()
+        audio_cache.close()
+        loop_buffer.close()
+        loudness.close()
+        await spotify.close()
+        resolver.close()
+        # Blocks until queued history is committed (or handed to the data service)
+        await self.bot.loop.run_in_executor(None, data_client.close)
+        await self.bot.loop.run_in_executor(None, metadata_cache.close)
+
+    def register_metrics(self):
+        # Gauges read from the cog's state when /metrics is scraped
+        registry = metrics.registry
+        self.metric_names = [metric.name for metric in (
+            registry.gauge('music_voice_connections', 'Connected voice clients', callback=lambda: len(self.bot.voice_clients)),
+            registry.gauge(
+                'music_queue_depth', 'Tracks waiting in each non-empty guild queue',
+                callback=lambda: {(str(guild_id),): len(queue) for guild_id, queue in self.queues.items() if queue},
+                labels=('guild',),
+            ),
+            registry.gauge('music_resolver_queue_depth', 'Lookups waiting for a resolver worker', callback=lambda: resolver.stats()['queue_depth']),
+            registry.gauge('music_resolver_in_flight', 'Lookups being resolved right now', callback=lambda: resolver.stats()['in_flight']),
+            registry.counter('music_resolver_resolved_total', 'Lookups resolved by the resolver pool', callback=lambda: resolver.resolved),
+            registry.counter('music_resolver_failed_total', 'Lookups that raised an error', callback=lambda: resolver.failed),
+            registry.counter('music_resolver_coalesced_total', 'Lookups answered by an identical one already in flight', callback=lambda: resolver.coalesced),
+            registry.gauge('music_audio_cache_bytes', 'Size of the on-disk audio cache', callback=lambda: audio_cache.stats()['bytes']),
+            registry.counter('music_audio_cache_hits_total', 'Tracks played from the audio cache', callback=lambda: audio_cache.hits),
+            registry.gauge('music_guild_states', 'Guilds the cog is keeping state for', callback=lambda: len(self.guild_state_ids())),
+            registry.gauge('music_loop_buffer_bytes', 'Size of the local copies kept for loop mode', callback=lambda: loop_buffer.size),
+            registry.counter('music_loop_replays_total', 'Loops replayed from a local copy instead of the network', callback=lambda: loop_buffer.replays),
+            registry.counter('music_loop_buffer_stored_total', 'Local copies made for loop mode', callback=lambda: loop_buffer.stored),
+            registry.counter('music_loop_buffer_over_budget_total', 'Looping tracks streamed again because their copy would not fit', callback=lambda: loop_buffer.over_budget),
+            registry.counter('music_loudness_analyzed_total', 'Tracks whose loudness has been measured', callback=lambda: loudness.analyzed),
+            registry.counter('music_loudness_failed_total', 'Loudness analyses that failed', callback=lambda: loudness.failed),
+            registry.gauge('music_loudness_pending', 'Tracks waiting for loudness analysis', callback=lambda: loudness.stats()['pending']),
+            registry.counter('music_metadata_cache_hits_total', 'Lookups answered from the metadata cache', callback=lambda: metadata_cache.hits),
+            registry.counter('music_metadata_cache_misses_total', 'Lookups the metadata cache had no fresh entry for', callback=lambda: metadata_cache.misses),
+            registry.counter('music_metadata_cache_errors_total', 'Metadata cache reads and writes that failed', callback=lambda: metadata_cache.errors),
+        )]
+
+    @tasks.loop(seconds=metrics.METRICS_PUBLISH_INTERVAL)
+    async def publish_metrics(self):
+        try:
+            await self.bot.loop.run_in_executor(None, metrics.publish)
+        except Exception as e:
+            print(f"Could not publish metrics: {e}")
+
+    @tasks.loop(minutes=30)
+    async def refresh_audio_cache(self):
+        # The audio cache decides what to keep from SongHistory play counts
+        since = datetime.utcnow() - timedelta(days=AUDIO_CACHE_WINDOW_DAYS)
+        try:
+            counts = await self.bot.loop.run_in_executor(None, top_played, since, AUDIO_CACHE_MIN_PLAYS, AUDIO_CACHE_HOT_TRACKS)
+        except Exception as e:
+            print(f"Could not load play counts for the audio cache: {e}")
+            return
+        audio_cache.set_popularity(counts)
+
+    @refresh_audio_cache.before_loop
+    async def before_refresh_audio_cache(self):
+        # The web thread (or the data service) creates the tables while the bot logs in
+        await self.bot.wait_until_ready()
+        while not await self.bot.loop.run_in_executor(None, wait_db_ready, DB_READY_POLL):
+            pass
+
+    @tasks.loop(seconds=REAPER_INTERVAL)
+    async def reap_idle(self):
+        now = time.monotonic()
+        for vc in list(self.bot.voice_clients):
+            guild_id = vc.guild.id
+            if any(not member.bot for member in vc.channel.members):
+                self.alone_since.pop(guild_id, None)
+            else:
+                self.alone_since.setdefault(guild_id, now)
+            if vc.is_playing() or vc.is_paused() or self.queues.get(guild_id) or guild_id in self.imports:
+                self.idle_since.pop(guild_id, None)
+            else:
+                self.idle_since.setdefault(guild_id, now)
+
+            if guild_id in self.alone_since and now - self.alone_since[guild_id] >= EMPTY_CHANNEL_TIMEOUT:
+                reason = "everyone left the voice channel"
+                reaped = metrics.reaped_empty
+            elif guild_id in self.idle_since and now - self.idle_since[guild_id] >= IDLE_TIMEOUT:
+                reason = "nothing has been playing for a while"
+                reaped = metrics.reaped_idle
+            else:
+                continue
+            try:
+                await self.disconnect_idle(vc, reason)
+                reaped.inc()
+            except Exception as e:
+                print(f"Could not leave idle voice channel in guild {guild_id}: {e}")
+
+        # State of guilds the bot is no longer connected in (kicked, moved out by hand, ...)
+        connected = {vc.guild.id for vc in self.bot.voice_clients}
+        for guild_id in self.guild_state_ids() - connected:
+            self.release_guild(guild_id)
+
+    @reap_idle.before_loop
+    async def before_reap_idle(self):
+        await self.bot.wait_until_ready()
+
+    async def disconnect_idle(self, vc, reason):
+        panel = self.panels.get(vc.guild.id)
+        # Released before disconnecting so the after callback has nothing left to play
+        self.release_guild(vc.guild.id)
+        await vc.disconnect()
+        if panel is not None:
+            try:
+                await panel.channel.send(f"Left the voice channel because {reason}.")
+            except discord.HTTPException:
+                pass
+
+    def guild_state_ids(self):
+        # Volumes are a preference and outlive the connection
+        return (set(self.queues) | set(self.loops) | set(self.current) | set(self.panels) | set(self.imports)
+                | set(self.prefetched) | set(self.prefetch_tasks) | set(self.track_ended_at)
+                | set(self.idle_since) | set(self.alone_since) | set(self.play_locks))
+
+    def release_guild(self, guild_id):
+        # Drop everything kept for a guild: queue, loop flag, now playing message and its
+        # view, playlist import, Spotify matches under way and the prefetched FFmpeg process
+        if self.prefetched.get(guild_id) is not None:
+            metrics.released_players.inc()
+        self.cancel_import(guild_id)
+        self.cancel_prefetch(guild_id)
+        spotify.cancel(guild_id)
+        loop_buffer.discard(guild_id)
+        self.skipped.discard(guild_id)
+        queue = self.queues.pop(guild_id, None)
+        if queue:
+            metrics.released_tracks.inc(len(queue))
+        panel = self.panels.pop(guild_id, None)
+        if panel is not None:
+            panel.close()
+            metrics.released_views.inc()
+        for state in (self.loops, self.current, self.track_ended_at, self.idle_since, self.alone_since):
+            state.pop(guild_id, None)
+        # A play_next still holding it finds the voice client gone and returns
+        lock = self.play_locks.get(guild_id)
+        if lock is not None and not lock.locked():
+            del self.play_locks[guild_id]
+        metrics.released_guilds.inc()
+
+    def snapshot_state(self):
+        state = {}
+        guild_ids = set(self.current) | {guild_id for guild_id, queue in self.queues.items() if queue}
+        for guild_id in guild_ids:
+            guild = self.bot.get_guild(guild_id)
+            vc = guild.voice_client if guild else None
+            if vc is None or vc.channel is None:
+                continue
+            current = self.current.get(guild_id)
+            panel = self.panels.get(guild_id)
+            state[str(guild_id)] = {
+                'voice_channel_id': vc.channel.id,
+                'text_channel_id': panel.channel.id if panel else None,
+                'loop': self.loops.get(guild_id, False),
+                'volume': self.get_volume(guild_id),
+                'paused': vc.is_paused(),
+                'position': getattr(vc.source, 'position', 0) if current else 0,
+                'current': current.to_dict() if current else None,
+                'queue': [track.to_dict() for track in self.get_queue(guild_id)],
+            }
+        return state
+
+    @tasks.loop(seconds=SNAPSHOT_INTERVAL)
+    async def save_snapshot(self):
+        state = self.snapshot_state()
+        try:
+            await self.bot.loop.run_in_executor(None, write_snapshot, state)
+        except Exception as e:
+            print(f"Could not save playback snapshot: {e}")
+
+    async def restore_snapshot(self):
+        await self.bot.wait_until_ready()
+        state = read_snapshot() if restore_allowed() else {}
+        for index, (guild_id, entry) in enumerate(state.items()):
+            # Spread reconnects out instead of hitting the voice gateway for every guild at once
+            if index:
+                await asyncio.sleep(RESTORE_STAGGER)
+            try:
+                await self.restore_guild(int(guild_id), entry)
+            except Exception as e:
+                print(f"Could not restore playback in guild {guild_id}: {e}")
+        self.save_snapshot.start()
+
+    async def restore_guild(self, guild_id, entry):
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(entry['voice_channel_id']) if guild else None
+        # Don't rejoin a channel nobody is listening in anymore
+        if channel is None or not any(not member.bot for member in channel.members):
+            return
+        text_channel = guild.get_channel(entry.get('text_channel_id') or 0) or channel
+
+        members = {}
+        tracks = []
+        for item in ([entry['current']] if entry.get('current') else []) + entry.get('queue', []):
+            requester_id = item.get('requester_id')
+            if requester_id and requester_id not in members:
+                members[requester_id] = guild.get_member(requester_id)
+                if members[requester_id] is None:
+                    try:
+                        members[requester_id] = await guild.fetch_member(requester_id)
+                    except discord.HTTPException:
+                        pass
+            tracks.append(Track.from_dict(item, requester=members.get(requester_id)))
+
+        if guild.voice_client is None:
+            await channel.connect(self_deaf=True)
+        self.loops[guild_id] = entry.get('loop', False)
+        self.volumes[guild_id] = entry.get('volume', DEFAULT_VOLUME)
+        self.get_queue(guild_id).extend(tracks)
+
+        # Seek back into the track that was playing
+        ctx = RestoredContext(guild, text_channel)
+        await self.play_next(ctx, start=entry.get('position', 0) if entry.get('current') else 0)
+        if entry.get('paused') and guild.voice_client and guild.voice_client.is_playing():
+            guild.voice_client.pause()
 
     def get_queue(self, guild_id):
         if guild_id not in self.queues:
-            self.queues[guild_id] = []
+            self.queues[guild_id] = GuildQueue()
         return self.queues[guild_id]
 
-    async def play_next(self, ctx):
+    def get_panel(self, ctx):
+        panel = self.panels.get(ctx.guild.id)
+        if panel is None:
+            panel = self.panels[ctx.guild.id] = NowPlayingPanel(ctx.channel, MusicControlView(ctx, self))
+        return panel
+
+    def get_volume(self, guild_id):
+        return self.volumes.get(guild_id, DEFAULT_VOLUME)
+
+    def stop_current(self, vc):
+        # Skip or stop the playing track: the after callback moves on even in loop mode
+        self.skipped.add(vc.guild.id)
+        vc.stop()
+
+    def set_loop(self, guild_id, enabled):
+        self.loops[guild_id] = enabled
+        # Looping plays the current track again instead of the prefetched head of the queue
+        self.cancel_prefetch(guild_id)
+        track = self.current.get(guild_id)
+        if enabled and track is not None:
+            loop_buffer.fill(guild_id, track)
+        else:
+            loop_buffer.discard(guild_id)
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None:
+                self.prefetch_rest(guild)
+
+    def clear_queue(self, guild_id):
+        self.cancel_import(guild_id)
+        self.get_queue(guild_id).clear()
+        self.cancel_prefetch(guild_id)
+        spotify.cancel(guild_id)
+
+    def cancel_import(self, guild_id):
+        playlist = self.imports.pop(guild_id, None)
+        if playlist is not None:
+            playlist.cancel()
+
+    async def import_playlist(self, ctx, url):
+        # The first entry starts playing as soon as it's listed; the rest are streamed
+        # into the queue in batches and only resolved when they get near the front
+        self.cancel_import(ctx.guild.id)
+        playlist = self.imports[ctx.guild.id] = PlaylistImport(url, requester=ctx.author)
         queue = self.get_queue(ctx.guild.id)
-        if len(queue) > 0:
-            player = queue.pop(0)
-            
-            # Log to history
-            if hasattr(player, 'requester'):
-                requester_id = player.requester.id
-                platform = player.data.get('extractor', 'unknown')
-                add_history(requester_id, player.title, player.data.get('webpage_url', 'local'), platform)
-
-            # Modern Dark Theme Embed
-            # Color: Dark Violet (0x8A2BE2)
-            embed = discord.Embed(
-                title="Now Playing",
-                description=f"[{player.title}]({player.data.get('webpage_url', '')})\n{player.data.get('uploader', 'Unknown Artist')}", 
-                color=0x8A2BE2 
-            )
-            
-            # Thumbnail: show song/video artwork (Right side small image)
-            if 'thumbnail' in player.data:
-                embed.set_thumbnail(url=player.data['thumbnail'])
-            
-            # Fields: Duration, Volume
-            if 'duration' in player.data:
-                duration = int(player.data['duration']) # Ensure duration is an integer
-                minutes = duration // 60
-                seconds = duration % 60
-                embed.add_field(name="Duration", value=f"{minutes}:{seconds:02d}", inline=True)
-            
-            # Volume (Default 50% from YTDLSource init)
-            current_vol = int(player.volume * 100) if hasattr(player, 'volume') else 100
-            embed.add_field(name="Volume", value=f"{current_vol}%", inline=True)
-            
-            embed.set_footer(text=f"Requested by {ctx.author.display_name}", icon_url=ctx.author.display_avatar.url)
+        queued = 0
+        full = False
+        progress = None
+        last_progress = time.monotonic()
+        try:
+            async for tracks in playlist.batches():
+                added = queue.extend(tracks)
+                queued += added
+                vc = ctx.voice_client
+                if added and vc and not vc.is_playing() and not vc.is_paused():
+                    await self.play_next(ctx)
+                if added < len(tracks):
+                    metrics.queue_rejected.inc(len(tracks) - added)
+                    full = True
+                    playlist.cancel()
+                    break
+                if time.monotonic() - last_progress >= PLAYLIST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    text = f"📥 Importing **{playlist.title or 'playlist'}**: {queued} songs queued..."
+                    progress = await self.send_or_edit(ctx, progress, text)
+        except Exception as e:
+            return await ctx.send(f'An error occurred: {str(e)}')
+        finally:
+            if self.imports.get(ctx.guild.id) is playlist:
+                del self.imports[ctx.guild.id]
 
-            # Create the view with buttons
-            view = MusicControlView(ctx, self)
-            
-            await ctx.send(embed=embed, view=view)
-            
-            ctx.voice_client.play(player, after=lambda e: self.bot.loop.create_task(self.after_playing(ctx, e)))
+        text = f"Queued **{queued} songs** from **{playlist.title or 'playlist'}**."
+        if full:
+            text += f" The queue is full ({queue.max_size} songs)."
+        elif playlist.cancelled:
+            text += " Import stopped."
+        await self.send_or_edit(ctx, progress, text)
+
+    async def send_or_edit(self, ctx, message, text):
+        if message is None:
+            return await ctx.send(text)
+        try:
+            await message.edit(content=text)
+            return message
+        except discord.NotFound:
+            return await ctx.send(text)
+
+    def queue_changed(self, guild):
+        # After a shuffle/remove/move: if the next track was already prefetched and is
+        # no longer next, drop it and prefetch the new head at the right time instead
+        self.resolve_ahead(guild.id)
+        entry = self.prefetched.get(guild.id)
+        queue = self.get_queue(guild.id)
+        if entry is None or (queue and queue[0] is entry[0]):
+            return
+        self.cancel_prefetch(guild.id)
+        self.prefetch_rest(guild)
+
+    def resolve_ahead(self, guild_id):
+        # Match the next few Spotify entries on YouTube before they come up
+        spotify.resolve_ahead(guild_id, self.get_queue(guild_id).page(0, SPOTIFY_LOOKAHEAD), loop=self.bot.loop)
+
+    def prefetch_rest(self, guild):
+        # Prefetch the head of the queue in time for the end of what is playing now
+        vc = guild.voice_client
+        track = self.current.get(guild.id)
+        if vc and vc.source and track and track.data.get('duration'):
+            self.schedule_prefetch(guild.id, track.data['duration'] - vc.source.position)
+
+    def schedule_prefetch(self, guild_id, duration):
+        self.cancel_prefetch(guild_id)
+        # Live streams and tracks without a duration have no known end to prefetch for
+        if not duration:
+            return
+        delay = max(0, duration - PREFETCH_SECONDS)
+        self.prefetch_tasks[guild_id] = self.bot.loop.create_task(self.prefetch(guild_id, delay))
+
+    def cancel_prefetch(self, guild_id):
+        task = self.prefetch_tasks.pop(guild_id, None)
+        if task is not None:
+            task.cancel()
+        entry = self.prefetched.pop(guild_id, None)
+        if entry is not None:
+            entry[1].cleanup()
+
+    async def prefetch(self, guild_id, delay):
+        await asyncio.sleep(delay)
+        queue = self.get_queue(guild_id)
+        # In loop mode the current track comes round again, not the head of the queue
+        if not queue or self.loops.get(guild_id):
+            return
+        if ffmpeg_count(guild_id) >= GUILD_FFMPEG_LIMIT:
+            # Over budget: the next track starts cold instead
+            metrics.ffmpeg_budget_denied.inc()
+            return
+        track = queue[0]
+        player = None
+        try:
+            player = await create_player(track, loop=self.bot.loop, volume=self.get_volume(guild_id), guild_id=guild_id)
+            await self.bot.loop.run_in_executor(None, player.prime)
+        except asyncio.CancelledError:
+            if player is not None:
+                player.cleanup()
+            raise
+        except Exception as e:
+            print(f"Prefetch failed for {track.title}: {e}")
+            if player is not None:
+                player.cleanup()
+            return
+        self.prefetched[guild_id] = (track, player)
+
+    def take_prefetched(self, guild_id, track):
+        entry = self.prefetched.pop(guild_id, None)
+        if entry is None:
+            return None
+        player = entry[1]
+        volume = self.get_volume(guild_id)
+        if entry[0] is track and player.volume != volume and not player.is_opus():
+            player.volume = volume
+        if entry[0] is track and player.volume == volume:
+            return player
+        # The queue changed since the prefetch (skip, stop, ...), or the volume did
+        # and it's baked into the Opus stream, so it's no use
+        player.cleanup()
+        return None
+
+    def record_gap(self, guild_id):
+        ended_at = self.track_ended_at.pop(guild_id, None)
+        if ended_at is None:
+            return
+        metrics.track_gap_seconds.observe(time.perf_counter() - ended_at)
+
+    async def play_next(self, ctx, start=0, replay=False):
+        # Serialised per guild: starting a track awaits (stream refresh, placeholder
+        # resolve), and two starts at once would pop two tracks for one voice client
+        lock = self.play_locks.get(ctx.guild.id)
+        if lock is None:
+            lock = self.play_locks[ctx.guild.id] = asyncio.Lock()
+        async with lock:
+            await self.start_next(ctx, start, replay)
+
+    async def start_next(self, ctx, start, replay):
+        failures = 0
+        while True:
+            # Another command may have started playback while we were waiting
+            if ctx.voice_client is None or ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+                return
+
+            queue = self.get_queue(ctx.guild.id)
+            # replay: loop mode starts the track that just ended again
+            track = self.current.get(ctx.guild.id) if replay else None
+            if track is None:
+                replay = False
+                if len(queue) > 0:
+                    track = queue.popleft()
+            if track is None:
+                return self.queue_finished(ctx)
+
+            # Use the already-buffered source if the prefetch got to this track
+            player = self.take_prefetched(ctx.guild.id, track) if not start else None
+            self.cancel_prefetch(ctx.guild.id)
+            if player is None:
+                try:
+                    # FFmpeg is only spawned now that the track is starting; a stream URL
+                    # that expired while the track sat in the queue is re-resolved here
+                    player = await create_player(track, loop=self.bot.loop, volume=self.get_volume(ctx.guild.id), start=start, guild_id=ctx.guild.id)
+                except Exception as e:
+                    await ctx.send(f'Could not play **{track.title}**: {str(e)}')
+                    if replay:
+                        self.current.pop(ctx.guild.id, None)
+                    replay, start = False, 0
+                    failures += 1
+                    if failures >= MAX_START_FAILURES:
+                        self.current.pop(ctx.guild.id, None)
+                        return await ctx.send(f"{failures} songs in a row couldn't be played, stopping here. `!play` carries on with the queue.")
+                    continue
+
+            vc = ctx.voice_client
+            # Disconnected (e.g. !leave) while the player was being built
+            if vc is None or vc.is_playing() or vc.is_paused():
+                player.cleanup()
+                if not replay and self.queues.get(ctx.guild.id) is queue:
+                    queue.appendleft(track)
+                return
+            # Start audio before any REST calls so they don't add to the gap
+            vc.play(player, after=lambda e: self.track_finished(ctx, e))
+            break
+
+        self.current[ctx.guild.id] = track
+        self.idle_since.pop(ctx.guild.id, None)
+        metrics.tracks_started.inc()
+        self.record_gap(ctx.guild.id)
+        duration = player.data.get('duration')
+        # A track resumed from a snapshot (or restarted part way) only has the rest left to play
+        self.schedule_prefetch(ctx.guild.id, max(0, duration - start) if duration else duration)
+        self.resolve_ahead(ctx.guild.id)
+        if not replay:
+            # Another round of a looping track isn't another play: it is neither counted
+            # towards caching nor logged again, and its loudness is already being measured
+            audio_cache.note_play(track)
+            loudness.note_play(track)
+        if self.loops.get(ctx.guild.id):
+            # Later rounds replay from a local copy rather than the network
+            loop_buffer.fill(ctx.guild.id, track)
         else:
-            # Queue finished
-            pass
+            loop_buffer.discard(ctx.guild.id)
+
+        # Log to history
+        if player.requester is not None and not replay:
+            requester_id = player.requester.id
+            platform = player.data.get('extractor', 'unknown')
+            # Uploads are recorded under their file name, which is what !history replays
+            title = player.data.get('upload') or player.title
+            add_history(requester_id, title, player.data.get('webpage_url', 'local'), platform)
+
+        panel = self.get_panel(ctx)
+        panel.view.update_buttons()
+        panel.update(self.now_playing_embed(player, track))
+
+    def queue_finished(self, ctx):
+        self.current.pop(ctx.guild.id, None)
+        self.track_ended_at.pop(ctx.guild.id, None)
+        self.idle_since.setdefault(ctx.guild.id, time.monotonic())
+        loop_buffer.discard(ctx.guild.id)
+        panel = self.panels.get(ctx.guild.id)
+        if panel is not None:
+            panel.update(discord.Embed(title="Queue Finished", description="Add more songs with `!play`.", color=0x8A2BE2), view=False)
+
+    def track_finished(self, ctx, error):
+        # The voice client's `after` callback, on the player thread
+        future = asyncio.run_coroutine_threadsafe(self.after_playing(ctx, error), self.bot.loop)
+        future.add_done_callback(log_failure)
+
+    def title_link(self, player):
+        # Uploaded files have no page to link to
+        webpage_url = player.data.get('webpage_url', '')
+        if webpage_url.startswith('http'):
+            return f"[{player.title}]({webpage_url})"
+        return f"**{player.title}**"
+
+    async def upload_track(self, ctx, filename):
+        # Track for a file on the dashboard, using its transcode when that is ready; None if it doesn't exist
+        filepath = os.path.join("uploads", filename)
+        if not os.path.exists(filepath):
+            return None
+        try:
+            upload = await self.bot.loop.run_in_executor(None, upload_info, filename)
+        except Exception as e:
+            print(f"Could not look up upload {filename}: {e}")
+            upload = None
+        return Track.from_file(filepath, requester=ctx.author, upload=upload)
+
+    def now_playing_embed(self, player, track):
+        # Modern Dark Theme Embed
+        # Color: Dark Violet (0x8A2BE2)
+        embed = discord.Embed(
+            title="Now Playing",
+            description=f"{self.title_link(player)}\n{player.data.get('uploader', 'Unknown Artist')}", 
+            color=0x8A2BE2 
+        )
+        
+        # Thumbnail: show song/video artwork (Right side small image)
+        if 'thumbnail' in player.data:
+            embed.set_thumbnail(url=player.data['thumbnail'])
+        
+        # Fields: Duration, Volume
+        if 'duration' in player.data:
+            duration = int(player.data['duration']) # Ensure duration is an integer
+            minutes = duration // 60
+            seconds = duration % 60
+            embed.add_field(name="Duration", value=f"{minutes}:{seconds:02d}", inline=True)
+        
+        # Volume (Default 50% from DEFAULT_VOLUME)
+        current_vol = int(player.volume * 100) if hasattr(player, 'volume') else 100
+        embed.add_field(name="Volume", value=f"{current_vol}%", inline=True)
+        
+        if track.requester is not None:
+            embed.set_footer(text=f"Requested by {track.requester.display_name}", icon_url=track.requester.display_avatar.url)
+        return embed
 
     async def after_playing(self, ctx, error):
+        # Nothing to measure or play next after a disconnect
+        if ctx.voice_client is not None:
+            self.track_ended_at[ctx.guild.id] = time.perf_counter()
         if error:
+            metrics.player_errors.inc()
             print(f"Player error: {error}")
-        await self.play_next(ctx)
+        skipped = ctx.guild.id in self.skipped
+        self.skipped.discard(ctx.guild.id)
+        # A track that failed isn't looped, it would only fail again
+        await self.play_next(ctx, replay=self.loops.get(ctx.guild.id, False) and not skipped and not error)
 
     @commands.command(name="join", help="Joins your voice channel")
     async def join(self, ctx):
@@ -178,57 +767,156 @@ class Music(commands.Cog):
     @commands.command(name="leave", help="Disconnects from the voice channel")
     async def leave(self, ctx):
         if ctx.voice_client:
-            self.queues[ctx.guild.id] = [] # Clear queue
+            self.release_guild(ctx.guild.id)
             await ctx.voice_client.disconnect()
             await ctx.send("Disconnected.")
         else:
             await ctx.send("I am not in a voice channel.")
 
-    @commands.command(name="play", help="Plays a song from a link or search query")
-    async def play(self, ctx, *, query):
+    async def join_author(self, ctx):
+        # Connects to the author's voice channel if needed; False (after telling them why) if they can't play here
         if not ctx.author.voice:
-            return await ctx.send("You are not connected to a voice channel.")
+            await ctx.send("You are not connected to a voice channel.")
+            return False
 
         if ctx.voice_client is None:
             await ctx.author.voice.channel.connect(self_deaf=True)
         
         if ctx.voice_client.channel != ctx.author.voice.channel:
-             return await ctx.send("You must be in the same voice channel as me to play music.")
+            await ctx.send("You must be in the same voice channel as me to play music.")
+            return False
+        return True
 
-        await ctx.send("🔍 Searching...", delete_after=5)
+    async def enqueue(self, ctx, tracks):
+        queue = self.get_queue(ctx.guild.id)
+        added = queue.extend(tracks)
+        skipped = len(tracks) - added
+        metrics.queue_rejected.inc(skipped)
+        tracks = tracks[:added]
+        if not tracks:
+            return await ctx.send(f"The queue is full ({queue.max_size} songs).")
         
+        if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
+            await self.play_next(ctx)
+            tracks = tracks[1:]
+        else:
+            self.resolve_ahead(ctx.guild.id)
+
+        if tracks:
+            # Notices from several quick !play commands go out as one message
+            note = f"{skipped} more didn't fit, the queue is full ({queue.max_size} songs)." if skipped else None
+            self.get_panel(ctx).notify_enqueued(tracks, note)
+
+    @commands.command(name="play", help="Plays a song from a link or search query")
+    async def play(self, ctx, *, query):
+        if not await self.join_author(ctx):
+            return
+
+        if is_playlist_url(query):
+            return await self.import_playlist(ctx, query)
+
         async with ctx.typing():
             try:
                 if query.startswith("file "):
                     filename = query[5:].strip()
-                    filepath = os.path.join("uploads", filename)
-                    if not os.path.exists(filepath):
+                    track = await self.upload_track(ctx, filename)
+                    if track is None:
                         return await ctx.send(f"File '{filename}' not found on server. Upload it on the dashboard!")
                     
-                    source = discord.FFmpegPCMAudio(filepath)
-                    player = discord.PCMVolumeTransformer(source, volume=0.5)
-                    player.title = filename
-                    player.data = {'webpage_url': 'local', 'extractor': 'local_file', 'uploader': 'Server'}
-                    player.requester = ctx.author
+                    tracks = [track]
+                elif is_spotify_url(query):
+                    # Playlists and albums expand to many entries that are matched on YouTube as they near the front
+                    tracks = await spotify.tracks_from_url(query, requester=ctx.author, loop=self.bot.loop)
+                    if not tracks:
+                        return await ctx.send("Couldn't find any songs on that Spotify link.")
                 else:
-                    player = await YTDLSource.from_url(query, loop=self.bot.loop, stream=True)
-                    player.requester = ctx.author
+                    tracks = [await Track.from_url(query, loop=self.bot.loop, requester=ctx.author)]
                 
-                queue = self.get_queue(ctx.guild.id)
-                queue.append(player)
-                
-                if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused():
-                    await self.play_next(ctx)
-                else:
-                    # Added to queue message - Match theme
-                    embed = discord.Embed(title="Added to Queue", description=f"**{player.title}**", color=0x8A2BE2)
-                    if 'thumbnail' in player.data:
-                        embed.set_thumbnail(url=player.data['thumbnail'])
-                    await ctx.send(embed=embed)
+                await self.enqueue(ctx, tracks)
                     
             except Exception as e:
                 await ctx.send(f'An error occurred: {str(e)}')
 
+    @commands.command(name="history", help="Searches your listening history and plays the best match")
+    async def history(self, ctx, *, terms):
+        async with ctx.typing():
+            try:
+                matches = await self.bot.loop.run_in_executor(None, search_history, ctx.author.id, terms, 5)
+            except Exception as e:
+                return await ctx.send(f'An error occurred: {str(e)}')
+        if not matches:
+            return await ctx.send(f"Nothing in your history matches **{terms}**.")
+        if not await self.join_author(ctx):
+            return
+
+        match = matches[0]
+        async with ctx.typing():
+            try:
+                if match['url'] == 'local':
+                    track = await self.upload_track(ctx, match['title'])
+                    if track is None:
+                        return await ctx.send(f"File '{match['title']}' is no longer on the server.")
+                else:
+                    track = await Track.from_url(match['url'], loop=self.bot.loop, requester=ctx.author)
+                await self.enqueue(ctx, [track])
+            except Exception as e:
+                return await ctx.send(f'An error occurred: {str(e)}')
+
+        if len(matches) > 1:
+            others = '\n'.join(f"• {other['title']}" for other in matches[1:])
+            await ctx.send(f"Replaying **{match['title']}**. Other matches:\n{others}")
+        else:
+            await ctx.send(f"Replaying **{match['title']}**.")
+
+    @commands.command(name="top", help="Shows the most played songs")
+    async def top(self, ctx, count: int = 10):
+        count = max(1, min(count, TOP_TRACKS_MAX))
+        try:
+            tracks = await self.bot.loop.run_in_executor(None, top_tracks, count)
+        except Exception as e:
+            return await ctx.send(f'An error occurred: {str(e)}')
+        if not tracks:
+            return await ctx.send("Nothing has been played yet.")
+
+        lines = [f"`{i}.` **{track['title']}** ({track['plays']} plays)" for i, track in enumerate(tracks, start=1)]
+        embed = discord.Embed(title="Top Songs", description="\n".join(lines), color=0x8A2BE2)
+        await ctx.send(embed=embed)
+
+    @commands.command(name="rebuildstats", help="Recomputes the listening statistics from the full history")
+    @commands.is_owner()
+    async def rebuildstats(self, ctx):
+        async with ctx.typing():
+            started = time.perf_counter()
+            try:
+                await self.bot.loop.run_in_executor(None, rebuild_rollups)
+            except Exception as e:
+                return await ctx.send(f'An error occurred: {str(e)}')
+        await ctx.send(f"Listening statistics rebuilt in {time.perf_counter() - started:.1f}s.")
+
+    @commands.command(name="stats", help="Shows performance metrics")
+    @commands.is_owner()
+    async def stats(self, ctx):
+        def latency(histogram):
+            if not histogram.count:
+                return "no samples"
+            return f"p50 {histogram.quantile(0.5) * 1000:.0f} ms • p95 {histogram.quantile(0.95) * 1000:.0f} ms ({histogram.count})"
+
+        embed = discord.Embed(title="Bot Stats", color=0x8A2BE2)
+        embed.add_field(name="Resolve", value=latency(metrics.resolve_seconds), inline=False)
+        embed.add_field(name="Player start", value=latency(metrics.player_start_seconds), inline=False)
+        embed.add_field(name="FFmpeg first frame", value=latency(metrics.first_frame_seconds), inline=False)
+        embed.add_field(name="Gap between tracks", value=latency(metrics.track_gap_seconds), inline=False)
+        embed.add_field(name="Event loop lag", value=f"{metrics.loop_lag_last.value * 1000:.1f} ms now • p95 {(metrics.loop_lag.quantile(0.95) or 0) * 1000:.1f} ms", inline=False)
+        embed.add_field(name="Voice connections", value=str(len(self.bot.voice_clients)), inline=True)
+        embed.add_field(name="FFmpeg processes", value=str(metrics.ffmpeg_processes.value), inline=True)
+        embed.add_field(name="Queued tracks", value=str(sum(len(queue) for queue in self.queues.values())), inline=True)
+        embed.add_field(name="Tracks played", value=str(metrics.tracks_started.value), inline=True)
+        embed.add_field(name="Player errors", value=str(metrics.player_errors.value), inline=True)
+        embed.add_field(name="Reaped", value=f"{metrics.reaped_empty.value} empty • {metrics.reaped_idle.value} idle", inline=True)
+        resolver_stats = resolver.stats()
+        embed.add_field(name="Resolver", value=f"{resolver_stats['queue_depth']} queued • {resolver_stats['in_flight']} in flight", inline=True)
+        await ctx.send(embed=embed)
+
     @commands.command(name="pause", help="Pauses the current track")
     async def pause(self, ctx):
         if ctx.voice_client and ctx.voice_client.is_playing():
@@ -248,8 +936,8 @@ class Music(commands.Cog):
     @commands.command(name="stop", help="Stops playback and clears the current audio")
     async def stop(self, ctx):
         if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-            self.queues[ctx.guild.id] = []
-            ctx.voice_client.stop()
+            self.clear_queue(ctx.guild.id)
+            self.stop_current(ctx.voice_client)
             await ctx.send("Stopped playback.")
         else:
             await ctx.send("Nothing is playing right now.")
@@ -257,11 +945,142 @@ class Music(commands.Cog):
     @commands.command(name="skip", help="Skips the current song")
     async def skip(self, ctx):
         if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-            ctx.voice_client.stop()
+            self.stop_current(ctx.voice_client)
             await ctx.send("Skipped.")
         else:
             await ctx.send("Nothing is playing right now.")
 
+    @commands.command(name="queue", help="Shows the upcoming songs")
+    async def queue(self, ctx, page: int = 1):
+        queue = self.get_queue(ctx.guild.id)
+        current = self.current.get(ctx.guild.id)
+        if not queue and current is None:
+            return await ctx.send("The queue is empty.")
+
+        pages = max(1, (len(queue) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        lines = [f"`{start + i + 1}.` {track.title}" for i, track in enumerate(queue.page(start, start + QUEUE_PAGE_SIZE))]
+
+        embed = discord.Embed(title="Queue", description="\n".join(lines) or "Nothing queued.", color=0x8A2BE2)
+        if current is not None:
+            embed.add_field(name="Now Playing", value=current.title, inline=False)
+        total = int(queue.total_duration())
+        embed.set_footer(text=f"Page {page}/{pages} • {len(queue)} songs • {total // 3600}:{total % 3600 // 60:02d}:{total % 60:02d}")
+        await ctx.send(embed=embed)
+
+    @commands.command(name="shuffle", help="Shuffles the queue")
+    async def shuffle(self, ctx):
+        queue = self.get_queue(ctx.guild.id)
+        if len(queue) < 2:
+            return await ctx.send("Not enough songs in the queue to shuffle.")
+        queue.shuffle()
+        self.queue_changed(ctx.guild)
+        await ctx.send(f"Shuffled {len(queue)} songs.")
+
+    @commands.command(name="remove", help="Removes the song at a queue position")
+    async def remove(self, ctx, position: int):
+        queue = self.get_queue(ctx.guild.id)
+        if not 1 <= position <= len(queue):
+            return await ctx.send(f"Position must be between 1 and {len(queue)}.")
+        track = queue.remove(position - 1)
+        self.queue_changed(ctx.guild)
+        await ctx.send(f"Removed **{track.title}**.")
+
+    @commands.command(name="move", help="Moves a song to another queue position")
+    async def move(self, ctx, source: int, destination: int):
+        queue = self.get_queue(ctx.guild.id)
+        if not (1 <= source <= len(queue) and 1 <= destination <= len(queue)):
+            return await ctx.send(f"Positions must be between 1 and {len(queue)}.")
+        track = queue.move(source - 1, destination - 1)
+        self.queue_changed(ctx.guild)
+        await ctx.send(f"Moved **{track.title}** to position {destination}.")
+
+    @commands.command(name="volume", help="Sets the playback volume (0-200%)")
+    async def volume(self, ctx, percent: int):
+        if not 0 <= percent <= 200:
+            return await ctx.send("Volume must be between 0 and 200.")
+
+        self.volumes[ctx.guild.id] = percent / 100
+        vc = ctx.voice_client
+        track = self.current.get(ctx.guild.id)
+        if vc and vc.source and track and (vc.is_playing() or vc.is_paused()):
+            player = vc.source
+            if not player.is_opus():
+                player.volume = percent / 100
+            else:
+                # Opus mode has the volume baked into FFmpeg's filter chain:
+                # restart the track from where it is now with the new level
+                try:
+                    await self.restart_at(ctx.guild.id, vc, track, player.position)
+                except Exception as e:
+                    return await ctx.send(f'An error occurred: {str(e)}')
+            if ctx.guild.id in self.panels:
+                self.panels[ctx.guild.id].update(self.now_playing_embed(vc.source, track))
+        await ctx.send(f"Volume set to {percent}%.")
+
+    async def restart_at(self, guild_id, vc, track, position):
+        # Swap the playing source for a new FFmpeg that starts `position` seconds in (an
+        # input-side -ss, so it skips straight there). The old source keeps playing until
+        # the new one has its first frame. Returns None if the track changed meanwhile.
+        # The prefetched next track is dropped first: it has the old volume baked in (Opus
+        # mode), and this keeps the restart within the guild's FFmpeg budget
+        self.cancel_prefetch(guild_id)
+        player = vc.source
+        with metrics.seek_seconds.time():
+            new_player = await create_player(track, loop=self.bot.loop, volume=self.get_volume(guild_id), start=position, guild_id=guild_id)
+            try:
+                await self.bot.loop.run_in_executor(None, new_player.prime)
+            except Exception:
+                new_player.cleanup()
+                raise
+        if vc.source is not player or not (vc.is_playing() or vc.is_paused()):
+            new_player.cleanup()
+            return None
+        was_paused = vc.is_paused()
+        new_player.take_over(player)
+        vc.source = new_player
+        if was_paused:
+            vc.pause()
+        if track.data.get('duration'):
+            self.schedule_prefetch(guild_id, track.data['duration'] - new_player.position)
+        return new_player
+
+    async def seek_current(self, ctx, position):
+        vc = ctx.voice_client
+        track = self.current.get(ctx.guild.id)
+        if not (vc and vc.source and track and (vc.is_playing() or vc.is_paused())):
+            return await ctx.send("Nothing is playing right now.")
+        duration = track.data.get('duration')
+        if not duration:
+            return await ctx.send("This song can't be seeked (it's a live stream).")
+        position = min(max(0, position), max(0, duration - 1))
+        async with ctx.typing():
+            try:
+                new_player = await self.restart_at(ctx.guild.id, vc, track, position)
+            except Exception as e:
+                return await ctx.send(f'An error occurred: {str(e)}')
+        if new_player is None:
+            return await ctx.send("The song changed in the meantime.")
+        await ctx.send(f"Jumped to {format_time(position)} / {format_time(duration)}.")
+
+    @commands.command(name="seek", help="Jumps to a position in the current song (e.g. 1:30)")
+    async def seek(self, ctx, position):
+        seconds = parse_time(position)
+        if seconds is None:
+            return await ctx.send("Give a position like `90`, `1:30` or `1:02:03`.")
+        await self.seek_current(ctx, seconds)
+
+    @commands.command(name="forward", help="Skips ahead in the current song")
+    async def forward(self, ctx, seconds: int = SEEK_STEP):
+        source = ctx.voice_client.source if ctx.voice_client else None
+        await self.seek_current(ctx, getattr(source, 'position', 0) + seconds)
+
+    @commands.command(name="rewind", help="Jumps back in the current song")
+    async def rewind(self, ctx, seconds: int = SEEK_STEP):
+        source = ctx.voice_client.source if ctx.voice_client else None
+        await self.seek_current(ctx, getattr(source, 'position', 0) - seconds)
+
     @commands.command(name="help", help="Shows this help message")
     async def help(self, ctx):
         embed = discord.Embed(
@@ -270,11 +1089,21 @@ class Music(commands.Cog):
             color=0x8A2BE2 # Dark Violet
         )
         
-        embed.add_field(name="!play <query/url>", value="Plays a song from YouTube, Spotify, or SoundCloud.", inline=False)
+        embed.add_field(name="!play <query/url>", value="Plays a song or playlist from YouTube, Spotify, or SoundCloud.", inline=False)
+        embed.add_field(name="!history <terms>", value="Finds a song in your history and plays it again.", inline=False)
+        embed.add_field(name="!top [count]", value="Shows the most played songs.", inline=False)
         embed.add_field(name="!pause", value="Pauses the current song.", inline=True)
         embed.add_field(name="!resume", value="Resumes the paused song.", inline=True)
         embed.add_field(name="!skip", value="Skips the current song.", inline=True)
         embed.add_field(name="!stop", value="Stops playback and clears the queue.", inline=True)
+        embed.add_field(name="!volume <0-200>", value="Sets the playback volume.", inline=True)
+        embed.add_field(name="!seek <position>", value="Jumps to a position, e.g. `1:30`.", inline=True)
+        embed.add_field(name="!forward [seconds]", value="Skips ahead in the song.", inline=True)
+        embed.add_field(name="!rewind [seconds]", value="Jumps back in the song.", inline=True)
+        embed.add_field(name="!queue [page]", value="Shows the upcoming songs.", inline=True)
+        embed.add_field(name="!shuffle", value="Shuffles the queue.", inline=True)
+        embed.add_field(name="!remove <position>", value="Removes a song from the queue.", inline=True)
+        embed.add_field(name="!move <from> <to>", value="Moves a song in the queue.", inline=True)
         embed.add_field(name="!join", value="Joins your voice channel.", inline=True)
         embed.add_field(name="!leave", value="Leaves the voice channel.", inline=True)
         embed.add_field(name="!help", value="Shows this message.", inline=True)
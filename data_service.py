@@ -0,0 +1,41 @@
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+import signal
+import sys
+import threading
+from web_app import add_history, top_played, search_history, top_tracks, upload_info, rebuild_rollups, history_writer, init_db, run, db_ready
+from utils.data_client import WEB_MODE
+from utils.ipc import IPCServer
+
+# Data service for the sharded runtime: the one process that owns music_bot.db.
+# Shard workers send history writes and dashboard queries here over IPC, and it
+# serves the web dashboard too. Started by launcher.py.
+handlers = {
+    'add_history': add_history,
+    'top_played': top_played,
+    'search_history': search_history,
+    'top_tracks': top_tracks,
+    'upload_info': upload_info,
+    'rebuild_rollups': rebuild_rollups,
+    'wait_db_ready': db_ready.wait,
+}
+
+if __name__ == '__main__':
+    server = IPCServer(handlers)
+    server.start()
+    print("Data service listening for shard workers.")
+    # launcher.py stops it with SIGTERM: exit through the finally below so queued history is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if WEB_MODE == 'external':
+            # The dashboard is served by wsgi.py; just keep the IPC server up
+            init_db()
+            threading.Event().wait()
+        else:
+            run()
+    finally:
+        server.close()
+        history_writer.close()
@@ -0,0 +1,16 @@
+import os
+
+# gunicorn settings for the dashboard: `gunicorn -c gunicorn_conf.py wsgi:app`.
+# `python wsgi.py` (what the launcher runs) applies the same settings.
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.getenv('WEB_WORKERS', 4))
+threads = int(os.getenv('WEB_THREADS', 4))
+
+def on_starting(server):
+    # In the master, once, before any worker is serving
+    from web_app import setup_once
+    setup_once()
+
+def post_worker_init(worker):
+    from web_app import start_upload_processor
+    start_upload_processor()
@@ -1,31 +1,138 @@
 import subprocess
+import secrets
+import random
 import time
 import sys
 import os
+import requests
+from dotenv import load_dotenv
 
-def run_bot():
-    # Get the current python executable path
-    python_executable = sys.executable
-    script_path = os.path.join(os.path.dirname(__file__), 'bot.py')
+load_dotenv()
+
+from utils.data_client import WEB_MODE
+
+# Restart delay doubles with every quick crash in a row: 5s, 10s, 20s... up to 5 minutes
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+# A run that lasted this long counts as healthy and resets the backoff
+STABLE_AFTER = 60
+
+# Sharded runtime: with SHARD_WORKERS > 1 the Discord shards are split across that many
+# bot processes, and a separate data service process owns the database and the dashboard.
+# SHARD_COUNT defaults to Discord's recommendation for the bot.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 1))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+
+class Supervised:
+    # One child process, restarted with backoff whenever it exits
+    def __init__(self, name, script, env=None):
+        self.name = name
+        self.script = script
+        self.env = env or {}
+        self.process = None
+        self.started = 0
+        self.restart_at = 0
+        self.quick_crashes = 0
+
+    def start(self):
+        # Handoff to the bot: it resumes guild playback from its snapshot unless
+        # it keeps crashing right after starting (see utils/snapshot.py)
+        env = dict(os.environ, **self.env, MUSIC_BOT_QUICK_CRASHES=str(self.quick_crashes))
+        script_path = os.path.join(os.path.dirname(__file__), self.script)
+        # Get the current python executable path
+        self.process = subprocess.Popen([sys.executable, script_path], env=env)
+        self.started = time.monotonic()
+
+    def poll(self):
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                print(f"🔄 Restarting {self.name}...")
+                self.start()
+            return
+        if self.process.poll() is None:
+            return
+
+        # If we get here, the process has exited
+        if now - self.started >= STABLE_AFTER:
+            self.quick_crashes = 0
+        else:
+            self.quick_crashes += 1
+        # Jitter keeps workers that died together from reconnecting in lockstep
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.quick_crashes)
+        delay += random.uniform(0, delay * 0.2)
+        print(f"⚠️ {self.name} crashed or stopped (exit code {self.process.returncode}). Restarting in {delay:.0f} seconds...")
+        self.process = None
+        self.restart_at = now + delay
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
 
+def recommended_shard_count():
+    response = requests.get(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f"Bot {os.getenv('DISCORD_TOKEN')}"},
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()['shards']
+
+def build_processes():
+    # WEB_MODE=external: the dashboard gets its own production WSGI process
+    web = [Supervised('web dashboard', 'wsgi.py', {'METRICS_PROCESS': 'web'})] if WEB_MODE == 'external' else []
+    if SHARD_WORKERS <= 1:
+        # Single process with the dashboard embedded, as before
+        return [Supervised('Music Bot', 'bot.py')] + web
+
+    shard_count = max(SHARD_COUNT or recommended_shard_count(), SHARD_WORKERS)
+    # Shared secret for the IPC channel between the workers and the data service
+    ipc_env = {'DATA_SERVICE_AUTHKEY': secrets.token_hex(16)}
+    processes = [Supervised('data service', 'data_service.py', dict(ipc_env, METRICS_PROCESS='data-service'))] + web
+    for worker in range(SHARD_WORKERS):
+        # Contiguous shard ranges: worker 0 gets 0..k-1, worker 1 gets k..2k-1, ...
+        shard_ids = range(worker * shard_count // SHARD_WORKERS, (worker + 1) * shard_count // SHARD_WORKERS)
+        env = dict(
+            ipc_env,
+            SHARD_COUNT=str(shard_count),
+            SHARD_IDS=','.join(str(shard_id) for shard_id in shard_ids),
+            SNAPSHOT_PATH=os.path.join('instance', f'playback_snapshot-{worker}.json'),
+            METRICS_PROCESS=f'shard-worker-{worker}',
+        )
+        processes.append(Supervised(f'shard worker {worker} (shards {shard_ids.start}-{shard_ids.stop - 1})', 'bot.py', env))
+    return processes
+
+def run_bot():
     print("🚀 Starting Music Bot with auto-restart enabled...")
-    
+
+    try:
+        processes = build_processes()
+    except Exception as e:
+        print(f"❌ Critical error in launcher: {e}")
+        return
+
+    for process in processes:
+        process.start()
+
     while True:
         try:
-            # Run the bot process
-            process = subprocess.Popen([python_executable, script_path])
-            process.wait()  # Wait for the process to finish
-            
-            # If we get here, the process has exited
-            print("⚠️ Bot crashed or stopped. Restarting in 5 seconds...")
-            time.sleep(5)
-            print("🔄 Restarting bot...")
-            
+            for process in processes:
+                process.poll()
+            time.sleep(1)
+
         except KeyboardInterrupt:
             print("\n🛑 Bot stopped by user.")
+            for process in processes:
+                process.stop()
             break
         except Exception as e:
             print(f"❌ Critical error in launcher: {e}")
+            for process in processes:
+                process.stop()
             break
 
 if __name__ == "__main__":
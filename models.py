@@ -11,6 +11,10 @@ class User(UserMixin, db.Model):
     history = db.relationship('SongHistory', backref='user', lazy=True)
 
 class SongHistory(db.Model):
+    # Dashboard reads are "latest plays of one user": this index serves them (and keyset
+    # pagination) without scanning the table. Existing databases get it from web_app.init_db.
+    __table_args__ = (db.Index('ix_song_history_user_played', 'user_id', 'played_at'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(20), db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(255), nullable=False)
@@ -20,8 +24,52 @@ class SongHistory(db.Model):
 
     def to_dict(self):
         return {
+            'id': self.id,
             'title': self.title,
             'url': self.url,
             'platform': self.platform,
             'played_at': self.played_at.strftime('%Y-%m-%d %H:%M:%S')
         }
+
+# Listening statistics rollups. They are updated by the history writer in the same
+# transaction as the plays they count (see utils/rollups.py), so the stats page and
+# !top never aggregate song_history themselves.
+class TrackPlayCount(db.Model):
+    # One row per song: its page URL, or "local:<file name>" for uploaded files
+    track_key = db.Column(db.String(512), primary_key=True)
+    title = db.Column(db.String(255), nullable=False)
+    url = db.Column(db.String(512), nullable=False)
+    platform = db.Column(db.String(50))
+    plays = db.Column(db.Integer, nullable=False, default=0, index=True)
+    last_played = db.Column(db.DateTime)
+
+class PlatformPlayCount(db.Model):
+    platform = db.Column(db.String(50), primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyPlayCount(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+class UploadedFile(db.Model):
+    # What the upload processor (utils/upload_processor.py) learned about a file in the
+    # uploads folder, and where its loudness-normalised Opus transcode is
+    filename = db.Column(db.String(255), primary_key=True)
+    title = db.Column(db.String(255))
+    artist = db.Column(db.String(255))
+    duration = db.Column(db.Float)
+    size = db.Column(db.Integer)
+    opus_path = db.Column(db.String(512))
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, ready, failed
+    error = db.Column(db.String(255))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'filename': self.filename,
+            'title': self.title,
+            'artist': self.artist,
+            'duration': self.duration,
+            'opus_path': self.opus_path,
+            'status': self.status,
+        }
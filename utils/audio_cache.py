@@ -0,0 +1,222 @@
+import asyncio
+import os
+import time
+from utils.metadata_cache import normalize_query
+
+# Optional on-disk cache of popular tracks, stored as Opus so they can be played (or
+# copied straight through in Opus mode) without touching YouTube again.
+AUDIO_CACHE_ENABLED = os.getenv('AUDIO_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes')
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# A track is cached once SongHistory has at least this many plays of it in the window
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', 3))
+AUDIO_CACHE_WINDOW_DAYS = 30
+AUDIO_CACHE_HOT_TRACKS = 1000 # how many of the most played URLs to consider
+AUDIO_CACHE_WORKERS = int(os.getenv('AUDIO_CACHE_WORKERS', 1)) # concurrent FFmpeg transcodes
+# A .part file not written to for this long belongs to a transcode that died
+AUDIO_CACHE_PART_MAX_AGE = 60 * 60
+
+FFMPEG_STREAM_OPTIONS = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+
+async def download_opus(url, path, *, is_opus):
+    # Copy a stream into an Opus file: already-Opus streams (YouTube webm) are remuxed,
+    # everything else transcoded. Written under a temporary name first (shard worker
+    # processes share directories) so a half-written file is never played.
+    part = f'{path}.{os.getpid()}.part'
+    codec = ['-c:a', 'copy'] if is_opus else ['-c:a', 'libopus', '-b:a', '128k']
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-loglevel', 'error', *FFMPEG_STREAM_OPTIONS, '-i', url,
+            '-vn', '-map_metadata', '-1', *codec, '-f', 'opus', '-y', part,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='ignore').strip() or 'ffmpeg failed')
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+def track_key(data):
+    if not data.get('id') or not data.get('extractor'):
+        return None
+    return f"{data['extractor']}-{data['id']}".replace(os.sep, '_')
+
+def url_key(url):
+    # SongHistory only has page URLs; map YouTube ones onto the same key as track_key
+    key = normalize_query(url)
+    if key.startswith('youtube:'):
+        return key.replace(':', '-', 1)
+    return key
+
+class AudioCache:
+    def __init__(self, directory=AUDIO_CACHE_DIR, *, max_bytes=AUDIO_CACHE_MAX_BYTES, enabled=AUDIO_CACHE_ENABLED):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.entries = None # key -> size in bytes, loaded from disk on first use
+        self.popularity = {} # url_key -> play count from SongHistory
+        self._pending = set() # keys being transcoded
+        self._tasks = set()
+        self._semaphore = asyncio.Semaphore(AUDIO_CACHE_WORKERS)
+        self.hits = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan(startup=True)
+
+    def _scan(self, *, startup=False):
+        # The shard worker processes share the directory: read it again to see what the
+        # others stored or evicted. A .part file may be another worker's transcode in
+        # progress, so only ones left by an earlier process with this PID (at startup,
+        # before this one wrote any) or abandoned long ago are removed.
+        own_part = f'.{os.getpid()}.part'
+        abandoned = time.time() - AUDIO_CACHE_PART_MAX_AGE
+        entries = {}
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.opus'):
+                    entries[entry.name[:-5]] = entry.stat().st_size
+                elif entry.name.endswith('.part') and (
+                    (startup and entry.name.endswith(own_part)) or entry.stat().st_mtime < abandoned
+                ):
+                    os.remove(entry.path)
+            except OSError:
+                pass # removed by another worker meanwhile
+        self.entries = entries
+
+    def _on_disk(self, key):
+        # Known here, or stored by another worker since the last scan
+        if key not in self.entries:
+            try:
+                self.entries[key] = os.path.getsize(self._path(key))
+            except OSError:
+                return False
+        return True
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.opus')
+
+    @property
+    def size(self):
+        self._load()
+        return sum(self.entries.values())
+
+    def set_popularity(self, counts):
+        # counts: page URL -> number of plays
+        popularity = {}
+        for url, plays in counts.items():
+            key = url_key(url)
+            popularity[key] = popularity.get(key, 0) + plays
+        self.popularity = popularity
+
+    def contains(self, track):
+        # Like path_for, without counting a hit
+        if not self.enabled or track.local:
+            return False
+        self._load()
+        key = track_key(track.data)
+        return key is not None and self._on_disk(key)
+
+    def path_for(self, track):
+        # Local file for a track, if it is cached. The mtime doubles as last-used time.
+        if not self.enabled or track.local:
+            return None
+        self._load()
+        key = track_key(track.data)
+        if key is None or not self._on_disk(key):
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            del self.entries[key]
+            return None
+        self.hits += 1
+        return path
+
+    def note_play(self, track):
+        # Called when a streamed track starts: cache it in the background if it's popular
+        if not self.enabled or track.local or not track.url:
+            return
+        self._load()
+        key = track_key(track.data)
+        if key is None or key in self._pending or self._on_disk(key):
+            return
+        plays = max(self.popularity.get(key, 0), self.popularity.get(url_key(track.data.get('webpage_url', '')), 0))
+        if plays < AUDIO_CACHE_MIN_PLAYS:
+            return
+        self._pending.add(key)
+        task = asyncio.get_running_loop().create_task(self._store(key, track.url, track.data.get('acodec') == 'opus'))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _store(self, key, url, is_opus):
+        path = self._path(key)
+        try:
+            async with self._semaphore:
+                # Another worker may have stored it while this one waited for a slot
+                if self._on_disk(key):
+                    return
+                await download_opus(url, path, is_opus=is_opus)
+            self.entries[key] = os.path.getsize(path)
+            self.stored += 1
+            self._evict()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Audio cache transcode failed for {key}: {e}")
+        finally:
+            self._pending.discard(key)
+
+    def _evict(self):
+        # LFU by SongHistory plays, least recently used first among equals. The budget
+        # covers every worker's files, so it is checked against the directory itself.
+        self._scan()
+        total = sum(self.entries.values())
+        if total <= self.max_bytes:
+            return
+        candidates = []
+        for key, size in self.entries.items():
+            try:
+                last_used = os.path.getmtime(self._path(key))
+            except OSError:
+                last_used = 0
+            candidates.append((self.popularity.get(key, 0), last_used, key, size))
+        candidates.sort()
+        for _, _, key, size in candidates:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass # evicted by another worker
+            del self.entries[key]
+            total -= size
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'files': len(self.entries or {}),
+            'bytes': sum((self.entries or {}).values()),
+            'hits': self.hits,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'pending': len(self._pending),
+        }
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+audio_cache = AudioCache()
@@ -0,0 +1,86 @@
+import os
+import time
+
+# How the bot reaches music_bot.db. In a sharded deployment (launcher.py with
+# SHARD_WORKERS > 1) every worker talks to the data service over IPC; otherwise the
+# web app is imported and used in-process as before.
+DATA_SERVICE_ENABLED = bool(os.getenv('DATA_SERVICE_AUTHKEY'))
+# 'embedded': the dashboard runs on Flask's development server in a thread of the bot (or
+# data service) process. 'external': it runs on its own via wsgi.py and shares only the database.
+WEB_MODE = os.getenv('WEB_MODE', 'embedded').lower()
+
+REBUILD_TIMEOUT = 600 # seconds
+
+_client = None
+
+def _ipc():
+    global _client
+    if _client is None:
+        from utils.ipc import IPCClient
+        _client = IPCClient()
+    return _client
+
+def add_history(user_id, title, url, platform):
+    if DATA_SERVICE_ENABLED:
+        _ipc().notify('add_history', user_id, title, url, platform)
+    else:
+        from web_app import add_history
+        add_history(user_id, title, url, platform)
+
+def top_played(since, min_plays, limit):
+    # Blocking: call from an executor
+    if DATA_SERVICE_ENABLED:
+        return _ipc().call('top_played', since, min_plays, limit)
+    from web_app import top_played
+    return top_played(since, min_plays, limit)
+
+def search_history(user_id, terms, limit):
+    # Blocking: call from an executor
+    if DATA_SERVICE_ENABLED:
+        return _ipc().call('search_history', user_id, terms, limit)
+    from web_app import search_history
+    return search_history(user_id, terms, limit)
+
+def top_tracks(limit):
+    # Blocking: call from an executor
+    if DATA_SERVICE_ENABLED:
+        return _ipc().call('top_tracks', limit)
+    from web_app import top_tracks
+    return top_tracks(limit)
+
+def upload_info(filename):
+    # Blocking: call from an executor
+    if DATA_SERVICE_ENABLED:
+        return _ipc().call('upload_info', filename)
+    from web_app import upload_info
+    return upload_info(filename)
+
+def rebuild_rollups():
+    # Blocking: call from an executor
+    if DATA_SERVICE_ENABLED:
+        # Reads the whole history: allowed far longer than the other calls
+        return _ipc().call('rebuild_rollups', timeout=REBUILD_TIMEOUT)
+    from web_app import rebuild_rollups
+    return rebuild_rollups()
+
+def wait_db_ready(timeout):
+    # Blocking: call from an executor. True once music_bot.db has its tables, False if
+    # that didn't happen within `timeout` seconds (or the data service isn't up yet)
+    if DATA_SERVICE_ENABLED:
+        from utils.ipc import IPC_CALL_TIMEOUT
+        try:
+            return _ipc().call('wait_db_ready', timeout, timeout=timeout + IPC_CALL_TIMEOUT)
+        except (OSError, EOFError):
+            time.sleep(timeout)
+            return False
+    from web_app import db_ready
+    return db_ready.wait(timeout)
+
+def close():
+    # Flush pending history writes
+    if DATA_SERVICE_ENABLED:
+        if _client is not None:
+            _client.close()
+    else:
+        from web_app import history_writer
+        history_writer.close()
@@ -0,0 +1,72 @@
+import os
+import random
+from collections import deque
+from itertools import islice
+
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 1000))
+
+class GuildQueue:
+    # Per-guild song queue on a deque: O(1) append and pop from the front.
+    # Entries are Track objects; unresolved ones (playlist entries) stay placeholders
+    # until they get near the front.
+    def __init__(self, max_size=MAX_QUEUE_SIZE):
+        self.max_size = max_size
+        self._tracks = deque()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks)
+
+    def __getitem__(self, index):
+        return self._tracks[index]
+
+    @property
+    def free(self):
+        return max(0, self.max_size - len(self._tracks))
+
+    def append(self, track):
+        if not self.free:
+            return False
+        self._tracks.append(track)
+        return True
+
+    def extend(self, tracks):
+        # Bulk enqueue up to the size limit; returns how many were added
+        tracks = list(islice(tracks, self.free))
+        self._tracks.extend(tracks)
+        return len(tracks)
+
+    def popleft(self):
+        return self._tracks.popleft()
+
+    def appendleft(self, track):
+        # Puts back a track that was taken off the front but couldn't start; it had a
+        # place in the queue, so the size limit doesn't apply
+        self._tracks.appendleft(track)
+
+    def clear(self):
+        self._tracks.clear()
+
+    def page(self, start, stop):
+        return list(islice(self._tracks, start, stop))
+
+    def shuffle(self):
+        # random.shuffle on a deque is O(n^2) (indexing is O(n)); shuffle a list copy instead
+        tracks = list(self._tracks)
+        random.shuffle(tracks)
+        self._tracks = deque(tracks)
+
+    def remove(self, index):
+        track = self._tracks[index]
+        del self._tracks[index]
+        return track
+
+    def move(self, source, destination):
+        track = self.remove(source)
+        self._tracks.insert(destination, track)
+        return track
+
+    def total_duration(self):
+        return sum(track.data.get('duration') or 0 for track in self._tracks)
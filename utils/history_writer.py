@@ -0,0 +1,99 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert
+from models import db, User, SongHistory
+from utils import metrics, rollups
+
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', 100)) # commit once this many plays are waiting
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 2.0)) # ...or this many seconds after the first
+
+_STOP = object()
+
+class HistoryWriter:
+    # Song history is written by a background thread instead of on the event loop.
+    # Plays are queued in memory and inserted in batches with one commit per batch.
+    def __init__(self, app):
+        self.app = app
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._batch_len = 0
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def add(self, user_id, title, url, platform):
+        self.start()
+        self._queue.put({
+            'user_id': str(user_id),
+            'title': title[:255],
+            'url': url[:512],
+            'platform': platform,
+            'played_at': datetime.utcnow(),
+        })
+
+    @property
+    def pending(self):
+        return self._queue.qsize() + self._batch_len
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush(batch)
+                self._batch_len = 0
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+                batch.append(item)
+                self._batch_len = len(batch)
+            if batch and (len(batch) >= HISTORY_BATCH_SIZE or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                self._batch_len = 0
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        with metrics.history_flush_seconds.time(), self.app.app_context():
+            try:
+                # Users who never logged into the dashboard get a placeholder row,
+                # all in one statement; existing users are left alone
+                user_ids = {row['user_id'] for row in batch}
+                db.session.execute(
+                    insert(User).prefix_with('OR IGNORE'),
+                    [{'id': user_id, 'username': 'Unknown User', 'avatar_url': ''} for user_id in user_ids],
+                )
+                db.session.execute(insert(SongHistory), batch)
+                rollups.apply(batch)
+                db.session.commit()
+                self.written += len(batch)
+            except Exception as e:
+                db.session.rollback()
+                self.dropped += len(batch)
+                print(f"Failed to write {len(batch)} history entries: {e}")
+
+    def close(self):
+        # Flush whatever is queued and stop the thread
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
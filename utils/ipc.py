@@ -0,0 +1,171 @@
+import os
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# Small request/notify channel between the shard workers and the data service process,
+# which is the only process that touches music_bot.db. Built on multiprocessing
+# connections, which authenticate both ends with the shared authkey.
+DATA_SERVICE_HOST = '127.0.0.1'
+DATA_SERVICE_PORT = int(os.getenv('DATA_SERVICE_PORT', 8765))
+NOTIFY_RETRY_DELAY = 1.0
+NOTIFY_MAX_PENDING = 10000
+# Calls each use a connection of their own, kept for reuse up to this many idle ones
+IPC_POOL_SIZE = 4
+IPC_CALL_TIMEOUT = float(os.getenv('IPC_CALL_TIMEOUT', 10)) # seconds to wait for a reply
+
+def service_address():
+    return (DATA_SERVICE_HOST, DATA_SERVICE_PORT)
+
+def service_authkey():
+    return os.getenv('DATA_SERVICE_AUTHKEY', '').encode()
+
+class IPCServer:
+    def __init__(self, handlers, *, address=None, authkey=None):
+        self.handlers = handlers
+        self.address = address or service_address()
+        self.authkey = authkey or service_authkey()
+        self._listener = None
+
+    def start(self):
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept_loop, name='ipc-accept', daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # Failed handshake (wrong authkey) or listener closed
+                if self._listener is None:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name='ipc-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    kind, method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                result, error = None, None
+                try:
+                    result = self.handlers[method](*args)
+                except Exception as e:
+                    error = f'{type(e).__name__}: {e}'
+                    print(f"IPC {method} failed: {error}")
+                if kind == 'call':
+                    try:
+                        conn.send((result, error))
+                    except (EOFError, OSError):
+                        # The caller gave up waiting and closed its connection
+                        return
+
+    def close(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+class IPCClient:
+    def __init__(self, *, address=None, authkey=None):
+        self.address = address or service_address()
+        self.authkey = authkey or service_authkey()
+        self._idle = [] # connections free for the next call
+        self._lock = threading.Lock()
+        self._notify_conn = None # owned by the notify thread
+        self._outbox = queue.Queue(maxsize=NOTIFY_MAX_PENDING)
+        self._sender = None
+        self.dropped = 0
+        self.timeouts = 0
+
+    def _connect(self):
+        return Client(self.address, authkey=self.authkey)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _checkin(self, conn):
+        with self._lock:
+            if len(self._idle) < IPC_POOL_SIZE:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def call(self, method, *args, timeout=IPC_CALL_TIMEOUT):
+        # Blocking request/response; run it in an executor from async code. Every call
+        # has a connection to itself, so a slow one doesn't hold up the others, and a
+        # data service that doesn't answer in time raises TimeoutError.
+        for attempt in range(2):
+            conn = self._checkout()
+            try:
+                conn.send(('call', method, args))
+                replied = conn.poll(timeout)
+                if replied:
+                    result, error = conn.recv()
+            except (EOFError, OSError):
+                # The data service restarted: reconnect once
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            if not replied:
+                # The late reply would be read by the next call: drop the connection
+                conn.close()
+                self.timeouts += 1
+                raise TimeoutError(f'no reply to {method} from the data service within {timeout:g}s')
+            self._checkin(conn)
+            if error:
+                raise RuntimeError(error)
+            return result
+
+    def notify(self, method, *args):
+        # Fire-and-forget, sent by a background thread so callers never block
+        if self._sender is None:
+            self._sender = threading.Thread(target=self._send_loop, name='ipc-notify', daemon=True)
+            self._sender.start()
+        try:
+            self._outbox.put_nowait((method, args))
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def pending(self):
+        return self._outbox.qsize()
+
+    def _send_loop(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            method, args = item
+            while True:
+                try:
+                    # A connection of its own, so notifications never queue behind calls
+                    if self._notify_conn is None:
+                        self._notify_conn = self._connect()
+                    self._notify_conn.send(('notify', method, args))
+                    break
+                except (EOFError, OSError) as e:
+                    self._notify_conn = None
+                    print(f"IPC notify {method} failed, retrying: {e}")
+                    time.sleep(NOTIFY_RETRY_DELAY)
+
+    def close(self, timeout=5):
+        # Let queued notifications go out before closing
+        if self._sender is not None:
+            self._outbox.put(None)
+            self._sender.join(timeout)
+            self._sender = None
+            if self._notify_conn is not None:
+                self._notify_conn.close()
+                self._notify_conn = None
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import shutil
+from utils.audio_cache import audio_cache, download_opus
+from utils.metrics import METRICS_PROCESS
+
+# Loop mode replays the current track from a local Opus copy instead of streaming it
+# again every time round. The copy is made in the background during the first play,
+# if the track's estimated size fits the budget; live streams and tracks that don't
+# fit are streamed again on each loop as before.
+LOOP_BUFFER_DIR = os.getenv('LOOP_BUFFER_DIR', 'loop_buffer')
+LOOP_BUFFER_MAX_BYTES = int(os.getenv('LOOP_BUFFER_MAX_BYTES', 512 * 1024 ** 2)) # all guilds together, 0 disables it
+LOOP_BUFFER_WORKERS = int(os.getenv('LOOP_BUFFER_WORKERS', 2)) # concurrent FFmpeg copies
+# Used to estimate a copy's size from the track duration before it is made (YouTube Opus tops out around 160k)
+LOOP_BUFFER_ESTIMATE_KBPS = 160
+
+class LoopBuffer:
+    def __init__(self, directory=LOOP_BUFFER_DIR, *, max_bytes=LOOP_BUFFER_MAX_BYTES):
+        # One directory per process: copies only live as long as the process that made them
+        self.directory = os.path.join(directory, METRICS_PROCESS)
+        self.max_bytes = max_bytes
+        self.entries = {} # guild_id -> [Track, size in bytes (estimated until ready), ready]
+        self._tasks = {} # guild_id -> asyncio.Task writing the copy
+        self._semaphore = asyncio.Semaphore(LOOP_BUFFER_WORKERS)
+        self._prepared = False
+        self.replays = 0
+        self.stored = 0
+        self.over_budget = 0
+
+    def _prepare(self):
+        # Copies left behind by an earlier run of this process are never used again
+        if not self._prepared:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self._prepared = True
+
+    def _path(self, guild_id):
+        return os.path.join(self.directory, f'{guild_id}.opus')
+
+    @property
+    def size(self):
+        return sum(entry[1] for entry in self.entries.values())
+
+    def fill(self, guild_id, track):
+        # Start copying the track that is looping in a guild (replacing its previous copy)
+        entry = self.entries.get(guild_id)
+        if entry is not None and entry[0] is track:
+            return
+        self.discard(guild_id)
+        if self.max_bytes <= 0 or track.local or not track.url or audio_cache.contains(track):
+            return
+        duration = track.data.get('duration')
+        if not duration:
+            return
+        estimate = int(duration * LOOP_BUFFER_ESTIMATE_KBPS * 1000 / 8)
+        if self.size + estimate > self.max_bytes:
+            self.over_budget += 1
+            return
+        self.entries[guild_id] = [track, estimate, False]
+        self._tasks[guild_id] = asyncio.get_running_loop().create_task(self._store(guild_id, track))
+
+    async def _store(self, guild_id, track):
+        path = self._path(guild_id)
+        try:
+            async with self._semaphore:
+                self._prepare()
+                await download_opus(track.url, path, is_opus=track.data.get('acodec') == 'opus')
+            self.entries[guild_id][1:] = [os.path.getsize(path), True]
+            self.stored += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Could not buffer {track.title} for loop mode: {e}")
+            # Kept (empty, never ready) so later rounds of this track don't try again
+            self.entries[guild_id][1] = 0
+        finally:
+            if self._tasks.get(guild_id) is asyncio.current_task():
+                del self._tasks[guild_id]
+
+    def path_for(self, guild_id, track):
+        # The local copy to replay, once it has been fully written
+        entry = self.entries.get(guild_id)
+        if entry is None or entry[0] is not track or not entry[2]:
+            return None
+        self.replays += 1
+        return self._path(guild_id)
+
+    def discard(self, guild_id):
+        task = self._tasks.pop(guild_id, None)
+        if task is not None:
+            task.cancel()
+        if self.entries.pop(guild_id, None) is not None:
+            try:
+                os.remove(self._path(guild_id))
+            except OSError:
+                pass
+
+    def close(self):
+        for guild_id in list(self.entries):
+            self.discard(guild_id)
+
+loop_buffer = LoopBuffer()
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import re
+import time
+from utils.audio_cache import FFMPEG_STREAM_OPTIONS
+from utils.metadata_cache import metadata_cache, cache_key
+from utils import metrics
+
+# Per-track loudness, measured once in the background after a track's first play and
+# stored next to its metadata. Later plays get a static gain towards LOUDNESS_TARGET,
+# folded into the volume FFmpeg already applies, instead of a live loudnorm filter.
+LOUDNESS_WORKERS = int(os.getenv('LOUDNESS_WORKERS', 1)) # concurrent analyses, 0 turns it off
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', -16)) # LUFS, what uploads are normalised to
+LOUDNESS_MAX_GAIN = 12 # dB either way
+LOUDNESS_TRUE_PEAK = -1.0 # dBTP the gain may raise a track's peak to
+# Analysis runs at a lower CPU priority, so it can't slow down live playback
+LOUDNESS_NICE = 10
+LOUDNESS_MAX_PENDING = 200
+LOUDNESS_TIMEOUT = 600 # seconds per FFmpeg run
+
+SUMMARY_RE = re.compile(r'I:\s+(-?[\d.]+|-?inf) LUFS.*?Peak:\s+(-?[\d.]+|-?inf) dBFS', re.S)
+
+def _lower_priority():
+    os.nice(LOUDNESS_NICE)
+
+class LoudnessAnalyzer:
+    def __init__(self, *, workers=LOUDNESS_WORKERS):
+        self.workers = workers
+        self._pending = set() # track keys queued or being analysed
+        self._failed = set() # not retried for the life of the process
+        self._tasks = set()
+        self._semaphore = asyncio.Semaphore(max(1, workers))
+        self.analyzed = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    async def gain_for(self, track):
+        # dB to apply to a track, 0 until it has been analysed
+        key = cache_key(track.data)
+        if not self.enabled or key is None:
+            return 0
+        measured = await metadata_cache.run(metadata_cache.get_loudness, key)
+        if measured is None or measured[0] is None:
+            return 0
+        integrated, true_peak = measured
+        gain = LOUDNESS_TARGET - integrated
+        if true_peak is not None:
+            gain = min(gain, LOUDNESS_TRUE_PEAK - true_peak)
+        return max(-LOUDNESS_MAX_GAIN, min(LOUDNESS_MAX_GAIN, gain))
+
+    def note_play(self, track):
+        # Called when a track starts: analyse it in the background unless that's been done
+        key = cache_key(track.data)
+        if not self.enabled or key is None or not track.url:
+            return
+        if key in self._pending or key in self._failed or len(self._pending) >= LOUDNESS_MAX_PENDING:
+            return
+        self._pending.add(key)
+        task = asyncio.get_running_loop().create_task(self._analyze(key, track.url, track.local, track.title))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _analyze(self, key, url, local, title):
+        try:
+            if await metadata_cache.run(metadata_cache.get_loudness, key) is not None:
+                return
+            async with self._semaphore:
+                started = time.perf_counter()
+                integrated, true_peak = await measure(url, local=local)
+                metrics.loudness_analysis_seconds.observe(time.perf_counter() - started)
+            await metadata_cache.run(metadata_cache.put_loudness, key, integrated, true_peak)
+            self.analyzed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            self._failed.add(key)
+            print(f"Loudness analysis failed for {title}: {e}")
+        finally:
+            self._pending.discard(key)
+
+    def stats(self):
+        return {'enabled': self.enabled, 'pending': len(self._pending), 'analyzed': self.analyzed, 'failed': self.failed}
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+async def measure(url, *, local=False):
+    # Integrated loudness (LUFS) and true peak (dBTP) of a file or stream, from FFmpeg's
+    # EBU R128 meter. None for a value that is -inf (silence).
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-threads', '1',
+        *([] if local else FFMPEG_STREAM_OPTIONS), '-i', url,
+        '-vn', '-af', 'ebur128=peak=true:framelog=verbose', '-f', 'null', '-',
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        preexec_fn=_lower_priority if os.name == 'posix' else None,
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), LOUDNESS_TIMEOUT)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        process.kill()
+        raise
+    output = stderr.decode(errors='ignore')
+    summary = SUMMARY_RE.search(output[output.rfind('Summary:'):])
+    if process.returncode != 0 or summary is None:
+        raise RuntimeError(output.strip().splitlines()[-1] if output.strip() else 'ffmpeg failed')
+    integrated, true_peak = (None if 'inf' in value else float(value) for value in summary.groups())
+    return integrated, true_peak
+
+loudness = LoudnessAnalyzer()
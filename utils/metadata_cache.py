@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+# Persistent cache of trimmed extract_info results, so a repeat !play (or the ytsearch:
+# generated for a Spotify link) doesn't need a yt-dlp round-trip. Lives next to
+# music_bot.db, which Flask-SQLAlchemy keeps in the instance folder.
+METADATA_CACHE_PATH = os.getenv('METADATA_CACHE_PATH', os.path.join('instance', 'metadata_cache.db'))
+METADATA_TTL = int(os.getenv('METADATA_TTL', 7 * 24 * 60 * 60)) # title, uploader, duration...
+STREAM_CACHE_TTL = int(os.getenv('STREAM_CACHE_TTL', 5 * 60)) # stream URLs without an expire= param
+STREAM_URL_MARGIN = 60 # don't hand out stream URLs that expire sooner than this
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv('METADATA_CACHE_MAX_ENTRIES', 50000))
+# Hits record last_used in memory; it is written for all of them at most this often
+LAST_USED_FLUSH_INTERVAL = 60
+
+# The parts of the info dict the cog uses. The stream URL is stored separately with its own expiry.
+CACHED_FIELDS = ('id', 'title', 'webpage_url', 'uploader', 'duration', 'thumbnail', 'extractor', 'acodec')
+
+YOUTUBE_ID_RE = re.compile(r'(?:youtube\.com/(?:watch\?.*v=|shorts/)|youtu\.be/)([A-Za-z0-9_-]{11})')
+
+def normalize_query(query):
+    query = query.strip()
+    match = YOUTUBE_ID_RE.search(query)
+    if match:
+        # Every form of a YouTube link maps to the same video
+        return f'youtube:{match.group(1)}'
+    if '://' in query:
+        # Other URLs may be case-sensitive
+        return query
+    return ' '.join(query.lower().split())
+
+def cache_key(data):
+    # Tracks are stored per extractor and video ID; None for entries without one (uploads)
+    if not data.get('id') or not data.get('extractor'):
+        return None
+    return f"{data['extractor']}:{data['id']}"
+
+def stream_expiry(url, now):
+    expire = parse_qs(urlparse(url).query).get('expire')
+    if expire:
+        try:
+            return int(expire[0])
+        except ValueError:
+            pass
+    return now + STREAM_CACHE_TTL
+
+class MetadataCache:
+    def __init__(self, path=METADATA_CACHE_PATH, *, max_entries=METADATA_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._executor = None
+        self._touched = {} # track_key -> last_used not written yet
+        self._touched_flushed = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def run(self, method, *args, **kwargs):
+        # Runs a cache call on the cache's own thread and returns an awaitable. SQLite
+        # can block for its whole busy timeout when shard workers write the same file,
+        # which must not happen on the event loop.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix='metadata-cache')
+        return asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    track_key TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    stream_url TEXT,
+                    stream_expires REAL,
+                    fetched_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_tracks_last_used ON tracks (last_used);
+                CREATE TABLE IF NOT EXISTS queries (
+                    query TEXT PRIMARY KEY,
+                    track_key TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_queries_track_key ON queries (track_key);
+                -- Measured once per track by utils.loudness, kept when the metadata is evicted
+                CREATE TABLE IF NOT EXISTS loudness (
+                    track_key TEXT PRIMARY KEY,
+                    integrated REAL,
+                    true_peak REAL,
+                    analyzed_at REAL NOT NULL
+                );
+            ''')
+            self._conn = conn
+        return self._conn
+
+    def get(self, query, *, need_stream=False):
+        # Returns trimmed metadata, including 'url' only while the cached stream URL is still good.
+        # With need_stream=True, a hit without a usable stream URL counts as a miss.
+        # Any database error counts as a miss: the resolver can still look the query up.
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    'SELECT t.track_key, t.data, t.stream_url, t.stream_expires, t.fetched_at FROM queries q '
+                    'JOIN tracks t ON t.track_key = q.track_key WHERE q.query = ?',
+                    (normalize_query(query),),
+                ).fetchone()
+                if row is None or now - row[4] > METADATA_TTL:
+                    self.misses += 1
+                    return None
+                data = json.loads(row[1])
+                if row[2] and row[3] - now > STREAM_URL_MARGIN:
+                    data['url'] = row[2]
+                elif need_stream:
+                    self.misses += 1
+                    return None
+                self._touched[row[0]] = now
+                if now - self._touched_flushed >= LAST_USED_FLUSH_INTERVAL:
+                    self._flush_touched(conn)
+                    conn.commit()
+        except sqlite3.Error as e:
+            self.errors += 1
+            self.misses += 1
+            print(f"Metadata cache lookup failed: {e}")
+            return None
+        self.hits += 1
+        return data
+
+    def _flush_touched(self, conn):
+        touched, self._touched = self._touched, {}
+        self._touched_flushed = time.time()
+        conn.executemany('UPDATE tracks SET last_used = ? WHERE track_key = ?', [(used, key) for key, used in touched.items()])
+
+    def put(self, query, data):
+        track_key = cache_key(data)
+        if track_key is None:
+            return
+        now = time.time()
+        cached = json.dumps({key: data[key] for key in CACHED_FIELDS if key in data})
+        stream_url = data.get('url')
+        expires = stream_expiry(stream_url, now) if stream_url else None
+        keys = {normalize_query(query), track_key}
+        if data.get('webpage_url'):
+            keys.add(normalize_query(data['webpage_url']))
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO tracks (track_key, data, stream_url, stream_expires, fetched_at, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (track_key, cached, stream_url, expires, now, now),
+                )
+                conn.executemany('INSERT OR REPLACE INTO queries (query, track_key) VALUES (?, ?)', [(key, track_key) for key in keys])
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    # Eviction goes by last_used, so bring it up to date first
+                    self._flush_touched(conn)
+                    self._evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Metadata cache write failed: {e}")
+
+    def get_loudness(self, track_key):
+        # (integrated LUFS, true peak dBTP) or None if the track hasn't been analysed (or
+        # the database can't be read right now)
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT integrated, true_peak FROM loudness WHERE track_key = ?', (track_key,),
+                ).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Loudness lookup failed: {e}")
+            return None
+        return tuple(row) if row else None
+
+    def put_loudness(self, track_key, integrated, true_peak):
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO loudness (track_key, integrated, true_peak, analyzed_at) VALUES (?, ?, ?, ?)',
+                    (track_key, integrated, true_peak, time.time()),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Loudness write failed: {e}")
+
+    def _evict(self, conn):
+        # Drop the least recently used tenth once over the cap
+        count = conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        if count <= self.max_entries:
+            return
+        excess = count - self.max_entries + self.max_entries // 10
+        conn.execute(
+            'DELETE FROM tracks WHERE track_key IN (SELECT track_key FROM tracks ORDER BY last_used LIMIT ?)',
+            (excess,),
+        )
+        conn.execute('DELETE FROM queries WHERE track_key NOT IN (SELECT track_key FROM tracks)')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    if self._touched:
+                        self._flush_touched(self._conn)
+                        self._conn.commit()
+                except sqlite3.Error as e:
+                    print(f"Metadata cache write failed: {e}")
+                self._conn.close()
+                self._conn = None
+
+metadata_cache = MetadataCache()
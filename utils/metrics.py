@@ -0,0 +1,254 @@
+import asyncio
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+# Dependency-free metrics for the hot paths, rendered in the Prometheus text format by
+# the dashboard's /metrics route. Every process has its own registry; processes that
+# don't serve the dashboard (shard workers, or the bot when WEB_MODE=external) publish
+# a snapshot to METRICS_DIR, which /metrics merges in with a `process` label.
+METRICS_PROCESS = os.getenv('METRICS_PROCESS', 'bot')
+METRICS_DIR = os.path.join('instance', 'metrics')
+METRICS_PUBLISH_INTERVAL = 15
+# Snapshots older than this belong to a process that is gone
+METRICS_STALE_AFTER = 4 * METRICS_PUBLISH_INTERVAL
+LOOP_LAG_INTERVAL = 0.5
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# For background FFmpeg runs over whole files
+FFMPEG_JOB_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Counter:
+    # `callback` reads a total kept elsewhere (e.g. ResolverPool.resolved) at collection time
+    def __init__(self, name, help, *, callback=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.callback = callback
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, {}, self.value if self.callback is None else self.callback())]
+
+class Gauge:
+    # Either set directly or computed at collection time by `callback`, which returns a
+    # number or a dict of label tuples -> number (label names in `labels`)
+    def __init__(self, name, help, *, callback=None, labels=()):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.callback = callback
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        if self.callback is None:
+            return [(self.name, {}, self.value)]
+        value = self.callback()
+        if not isinstance(value, dict):
+            return [(self.name, {}, value)]
+        return [(self.name, dict(zip(self.labels, key)), sample) for key, sample in value.items()]
+
+class Histogram:
+    def __init__(self, name, help, *, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        # Estimated from the buckets, interpolating linearly inside the one that holds it
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket', {'le': _format_value(bound)}, cumulative))
+        samples.append((f'{self.name}_sum', {}, self.sum))
+        samples.append((f'{self.name}_count', {}, self.count))
+        return samples
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class Registry:
+    TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def counter(self, name, help, **kwargs):
+        return self.register(Counter(name, help, **kwargs))
+
+    def gauge(self, name, help, **kwargs):
+        return self.register(Gauge(name, help, **kwargs))
+
+    def histogram(self, name, help, **kwargs):
+        return self.register(Histogram(name, help, **kwargs))
+
+    def collect(self):
+        # {name: {'type', 'help', 'samples': [[sample name, labels, value], ...]}}
+        families = {}
+        for name, metric in list(self.metrics.items()):
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Failed to collect metric {name}: {e}")
+                continue
+            families[name] = {
+                'type': self.TYPES[type(metric)],
+                'help': metric.help,
+                'samples': [[sample, labels, value] for sample, labels, value in samples],
+            }
+        return families
+
+registry = Registry()
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def publish():
+    # Write this process's snapshot for the process serving /metrics (atomically)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{METRICS_PROCESS}.json')
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'process': METRICS_PROCESS, 'pid': os.getpid(), 'time': time.time(), 'families': registry.collect()}, f)
+    os.replace(temp_path, path)
+
+def _published():
+    if not os.path.isdir(METRICS_DIR):
+        return []
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if snapshot['pid'] != os.getpid() and time.time() - snapshot['time'] <= METRICS_STALE_AFTER:
+            snapshots.append(snapshot)
+    return snapshots
+
+def render():
+    # Prometheus text exposition of this process and the published snapshots of the others
+    snapshots = [{'process': METRICS_PROCESS, 'families': registry.collect()}] + _published()
+    families = {}
+    for snapshot in snapshots:
+        for name, family in snapshot['families'].items():
+            merged = families.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': []})
+            for sample, labels, value in family['samples']:
+                merged['samples'].append((sample, dict(labels, process=snapshot['process']), value))
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample, labels, value in family['samples']:
+            label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+            lines.append(f'{sample}{{{label_text}}} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    # How late the event loop wakes a task that asked to sleep `interval` seconds. Run as
+    # a task for the life of the bot; anything blocking the loop shows up here.
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag.observe(lag)
+        loop_lag_last.set(lag)
+
+# Hot-path instruments, shared by the modules that feed them
+resolve_seconds = registry.histogram('music_resolve_seconds', 'Time to resolve a query or page URL into track info (yt-dlp)')
+player_start_seconds = registry.histogram('music_player_start_seconds', 'Time to build a player for a track, including a stream URL refresh')
+first_frame_seconds = registry.histogram('music_ffmpeg_first_frame_seconds', 'Time from spawning FFmpeg to its first audio frame')
+seek_seconds = registry.histogram('music_seek_seconds', 'Time to restart the current track at a new position (seek, Opus volume change)')
+track_gap_seconds = registry.histogram('music_track_gap_seconds', 'Silence between the end of one track and the start of the next')
+loudness_analysis_seconds = registry.histogram('music_loudness_analysis_seconds', 'Time to measure the loudness of one track', buckets=FFMPEG_JOB_BUCKETS)
+upload_processing_seconds = registry.histogram('music_upload_processing_seconds', 'Time to probe and transcode one upload', buckets=FFMPEG_JOB_BUCKETS)
+history_flush_seconds = registry.histogram('music_history_flush_seconds', 'Time to write one batch of plays to song_history')
+loop_lag = registry.histogram('music_event_loop_lag_seconds', 'Event loop scheduling delay', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+loop_lag_last = registry.gauge('music_event_loop_lag_last_seconds', 'Most recent event loop lag sample')
+ffmpeg_processes = registry.gauge('music_ffmpeg_processes', 'FFmpeg playback processes currently running')
+tracks_started = registry.counter('music_tracks_started_total', 'Tracks that started playing')
+player_errors = registry.counter('music_player_errors_total', 'Errors reported by the voice player after a track')
+ffmpeg_budget_denied = registry.counter('music_ffmpeg_budget_denied_total', 'Prefetches skipped because the guild was at its FFmpeg process limit')
+now_playing_sent = registry.counter('music_now_playing_sent_total', 'Now-playing messages posted')
+now_playing_edits = registry.counter('music_now_playing_edits_total', 'Edits of an existing now-playing message')
+now_playing_coalesced = registry.counter('music_now_playing_coalesced_total', 'Now-playing updates replaced by a newer one before they were shown')
+queue_rejected = registry.counter('music_queue_rejected_total', 'Tracks not queued because the guild queue was full')
+reaped_empty = registry.counter('music_reaped_empty_total', 'Voice connections closed because everyone left the channel')
+reaped_idle = registry.counter('music_reaped_idle_total', 'Voice connections closed after idling with nothing queued')
+released_guilds = registry.counter('music_released_guild_states_total', 'Per-guild states released on leaving a voice channel')
+released_views = registry.counter('music_released_views_total', 'Now playing views stopped and released')
+released_tracks = registry.counter('music_released_queued_tracks_total', 'Queued tracks dropped along with a released guild state')
+released_players = registry.counter('music_released_players_total', 'Prefetched FFmpeg players cleaned up along with a released guild state')
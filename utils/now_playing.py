@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+import discord
+from utils import metrics
+
+# Minimum seconds between edits of the now-playing message. Updates arriving faster
+# (e.g. skip spam) are coalesced and only the latest one is shown.
+NOW_PLAYING_DEBOUNCE = float(os.getenv('NOW_PLAYING_DEBOUNCE', 1.5))
+# "Added to Queue" notices within this window are merged into one message
+ENQUEUE_BATCH_SECONDS = float(os.getenv('ENQUEUE_BATCH_SECONDS', 2.0))
+ENQUEUE_LIST_LIMIT = 5
+
+class NowPlayingPanel:
+    # One now-playing message per guild, edited in place on every track change
+    def __init__(self, channel, view):
+        self.channel = channel
+        self.view = view
+        self.message = None
+        self._embed = None
+        self._update_task = None
+        self._last_update = 0
+        self._enqueued = []
+        self._enqueued_note = None
+        self._enqueue_task = None
+
+    def update(self, embed, *, view=True):
+        # view=False removes the buttons (e.g. when the queue has finished)
+        if self._embed is not None:
+            metrics.now_playing_coalesced.inc()
+        self._embed = (embed, view)
+        if self._update_task is None or self._update_task.done():
+            self._update_task = asyncio.get_running_loop().create_task(self._flush_update())
+
+    async def _flush_update(self):
+        # The first update goes out right away, later ones at most every NOW_PLAYING_DEBOUNCE
+        # seconds. Updates that arrive while a request is in flight go out after it.
+        while self._embed is not None:
+            delay = self._last_update + NOW_PLAYING_DEBOUNCE - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            (embed, with_view), self._embed = self._embed, None
+            self._last_update = time.monotonic()
+            await self._show(embed, self.view if with_view else None)
+
+    async def _show(self, embed, view):
+        try:
+            if self.message is not None:
+                try:
+                    await self.message.edit(embed=embed, view=view)
+                    metrics.now_playing_edits.inc()
+                    return
+                except discord.NotFound:
+                    # Someone deleted it; post a fresh one
+                    self.message = None
+            self.message = await self.channel.send(embed=embed, view=view)
+            metrics.now_playing_sent.inc()
+        except discord.HTTPException as e:
+            print(f"Could not update now playing message: {e}")
+
+    def notify_enqueued(self, tracks, note=None):
+        self._enqueued.extend(tracks)
+        if note:
+            self._enqueued_note = note
+        if self._enqueue_task is None or self._enqueue_task.done():
+            self._enqueue_task = asyncio.get_running_loop().create_task(self._flush_enqueued())
+
+    async def _flush_enqueued(self):
+        # Tracks queued while a notice is being sent get a notice of their own after it
+        while self._enqueued:
+            await asyncio.sleep(ENQUEUE_BATCH_SECONDS)
+            tracks, self._enqueued = self._enqueued, []
+            note, self._enqueued_note = self._enqueued_note, None
+            await self._send_enqueued(tracks, note)
+
+    async def _send_enqueued(self, tracks, note):
+        # Added to queue message - Match theme
+        if len(tracks) == 1:
+            description = f"**{tracks[0].title}**"
+        else:
+            lines = [f"• {track.title}" for track in tracks[:ENQUEUE_LIST_LIMIT]]
+            if len(tracks) > ENQUEUE_LIST_LIMIT:
+                lines.append(f"...and {len(tracks) - ENQUEUE_LIST_LIMIT} more")
+            description = f"**{len(tracks)} songs**\n" + "\n".join(lines)
+        if note:
+            description += f"\n{note}"
+        embed = discord.Embed(title="Added to Queue", description=description, color=0x8A2BE2)
+        if 'thumbnail' in tracks[0].data:
+            embed.set_thumbnail(url=tracks[0].data['thumbnail'])
+        try:
+            await self.channel.send(embed=embed)
+        except discord.HTTPException as e:
+            print(f"Could not send queue notice: {e}")
+
+    def close(self):
+        for task in (self._update_task, self._enqueue_task):
+            if task is not None:
+                task.cancel()
+        self.view.stop()
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import re
+import threading
+from utils.resolver import load_yt_dlp
+from utils.ytdl_source import Track, ytdl_format_options
+
+PLAYLIST_MAX_ENTRIES = int(os.getenv('PLAYLIST_MAX_ENTRIES', 500))
+PLAYLIST_BATCH_SIZE = 25 # entries handed to the queue at a time (the first one goes alone)
+
+# Flat, lazy listing: yt-dlp yields id/title/duration per entry page by page without
+# resolving any of them. Entries become placeholder Tracks, resolved near the head of the queue.
+playlist_options = dict(
+    ytdl_format_options,
+    noplaylist=False,
+    extract_flat='in_playlist',
+    lazy_playlist=True,
+    playlistend=PLAYLIST_MAX_ENTRIES,
+)
+
+PLAYLIST_URL_RE = re.compile(r'youtube\.com/playlist\?|soundcloud\.com/[^/]+/sets/')
+
+def is_playlist_url(url):
+    return PLAYLIST_URL_RE.search(url) is not None
+
+class PlaylistImport:
+    # Streams a playlist into a guild queue. The listing runs on its own thread and
+    # hands entries back to the event loop in batches; cancel() stops it between entries.
+    def __init__(self, url, *, requester=None):
+        self.url = url
+        self.requester = requester
+        self.title = None
+        self.listed = 0
+        self._cancelled = threading.Event()
+        self._batches = asyncio.Queue()
+        self._loop = None
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _send(self, item):
+        self._loop.call_soon_threadsafe(self._batches.put_nowait, item)
+
+    def _list_entries(self):
+        # Runs on the import thread
+        try:
+            ytdl = load_yt_dlp().YoutubeDL(playlist_options)
+            info = ytdl.extract_info(self.url, download=False, process=False)
+            self.title = info.get('title')
+            batch = []
+            for entry in info.get('entries') or []:
+                if self.cancelled:
+                    break
+                if not entry:
+                    continue
+                batch.append(entry)
+                # Send the first entry on its own so playback can start right away
+                if len(batch) >= PLAYLIST_BATCH_SIZE or self.listed == 0:
+                    self.listed += len(batch)
+                    self._send(batch)
+                    batch = []
+                if self.listed + len(batch) >= PLAYLIST_MAX_ENTRIES:
+                    break
+            if batch:
+                self.listed += len(batch)
+                self._send(batch)
+            self._send(None)
+        except Exception as e:
+            self._send(e)
+
+    async def batches(self):
+        # Async iterator over lists of placeholder Tracks
+        self._loop = asyncio.get_running_loop()
+        threading.Thread(target=self._list_entries, name='playlist-import', daemon=True).start()
+        while True:
+            item = await self._batches.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if self.cancelled:
+                return
+            yield [Track.from_flat(entry, requester=self.requester) for entry in item]
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of threads running yt-dlp extractions. Each gets its own YoutubeDL instance,
+# since a YoutubeDL object isn't safe to share between concurrent calls.
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', 4))
+
+def load_yt_dlp():
+    # yt-dlp is a big import (a noticeable part of bot startup), so it is only loaded
+    # when first needed. Safe to call from any thread; later calls are a dict lookup.
+    import yt_dlp
+    # Suppress noise about console usage from errors
+    yt_dlp.utils.bug_reports_message = lambda *args, **kwargs: ''
+    return yt_dlp
+
+class ResolverPool:
+    # Runs ytdl.extract_info on a dedicated thread pool instead of the loop's default executor.
+    # Pending requests are queued per guild and served round-robin, so one guild importing a
+    # big playlist can't starve the others, and identical in-flight requests share one extraction.
+    def __init__(self, ytdl_options, *, workers=RESOLVER_WORKERS):
+        self.ytdl_options = ytdl_options
+        self.workers = workers
+        self._local = threading.local()
+        self._executor = None
+        self._tasks = []
+        self._queues = {} # guild_id -> deque of pending (key, future)
+        self._turns = deque() # guild_ids with pending requests, in round-robin order
+        self._available = None # asyncio.Semaphore counting pending requests
+        self._inflight = {} # (query, download) -> Future shared by everyone asking for it
+        self.resolved = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def _get_ytdl(self):
+        # Called on a worker thread: lazily build that thread's own YoutubeDL
+        ytdl = getattr(self._local, 'ytdl', None)
+        if ytdl is None:
+            ytdl = self._local.ytdl = load_yt_dlp().YoutubeDL(self.ytdl_options)
+        return ytdl
+
+    def _extract(self, query, download):
+        return self._get_ytdl().extract_info(query, download=download)
+
+    def _start(self):
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='resolver')
+        self._available = asyncio.Semaphore(0)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def extract_info(self, query, *, guild_id=None, download=False):
+        self._start()
+        key = (query, download)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            if guild_id not in self._queues:
+                self._queues[guild_id] = deque()
+                self._turns.append(guild_id)
+            self._queues[guild_id].append((key, future))
+            self._available.release()
+        # shield: one caller giving up mustn't cancel the result for the others
+        return await asyncio.shield(future)
+
+    def _next_request(self):
+        guild_id = self._turns.popleft()
+        queue = self._queues[guild_id]
+        request = queue.popleft()
+        if queue:
+            self._turns.append(guild_id)
+        else:
+            del self._queues[guild_id]
+        return request
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._available.acquire()
+            key, future = self._next_request()
+            try:
+                data = await loop.run_in_executor(self._executor, self._extract, *key)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.resolved += 1
+                if not future.done():
+                    future.set_result(data)
+            finally:
+                self._inflight.pop(key, None)
+
+    def stats(self):
+        # Resolve latency is the music_resolve_seconds histogram (utils/ytdl_source.py)
+        return {
+            'workers': self.workers,
+            'queue_depth': sum(len(queue) for queue in self._queues.values()),
+            'queued_guilds': len(self._queues),
+            'in_flight': len(self._inflight),
+            'resolved': self.resolved,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+        }
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,95 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, text
+from sqlalchemy.dialects.sqlite import insert
+from models import db, TrackPlayCount, PlatformPlayCount, DailyPlayCount
+
+# Precomputed listening statistics. The history writer adds every batch of plays to the
+# rollup tables in the transaction that inserts them, so readers only ever touch these
+# small tables. rebuild() recomputes them from song_history if they drift or are new.
+
+def track_key(url, title):
+    # Uploaded files are all recorded with the URL "local"; tell them apart by name
+    return f'local:{title}' if url == 'local' else url
+
+def apply(batch):
+    # Count a batch of new SongHistory rows (the dicts the history writer inserts).
+    # Runs in the caller's session; the caller commits.
+    tracks = {}
+    platforms = Counter()
+    days = Counter()
+    for row in batch:
+        key = track_key(row['url'], row['title'])
+        track = tracks.setdefault(key, {'track_key': key, 'plays': 0})
+        track.update(title=row['title'], url=row['url'], platform=row['platform'], last_played=row['played_at'])
+        track['plays'] += 1
+        platforms[row['platform'] or 'unknown'] += 1
+        days[row['played_at'].date()] += 1
+
+    statement = insert(TrackPlayCount)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[TrackPlayCount.track_key],
+        set_={
+            'title': statement.excluded.title,
+            'url': statement.excluded.url,
+            'platform': statement.excluded.platform,
+            'plays': TrackPlayCount.plays + statement.excluded.plays,
+            'last_played': statement.excluded.last_played,
+        },
+    ), list(tracks.values()))
+    statement = insert(PlatformPlayCount)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[PlatformPlayCount.platform],
+        set_={'plays': PlatformPlayCount.plays + statement.excluded.plays},
+    ), [{'platform': platform, 'plays': plays} for platform, plays in platforms.items()])
+    statement = insert(DailyPlayCount)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[DailyPlayCount.day],
+        set_={'plays': DailyPlayCount.plays + statement.excluded.plays},
+    ), [{'day': day, 'plays': plays} for day, plays in days.items()])
+
+def rebuild():
+    # Recompute every rollup from song_history in one transaction. The DELETEs take the
+    # write lock first, so history batches committed meanwhile are counted exactly once.
+    for model in (TrackPlayCount, PlatformPlayCount, DailyPlayCount):
+        db.session.execute(delete(model))
+    # With a single max() aggregate SQLite takes the bare columns from the row holding
+    # the maximum, i.e. the latest title/platform recorded for the song
+    db.session.execute(text(
+        "INSERT INTO track_play_count (track_key, title, url, platform, plays, last_played) "
+        "SELECT CASE WHEN url = 'local' THEN 'local:' || title ELSE url END AS track_key, "
+        "title, url, platform, COUNT(*), MAX(played_at) FROM song_history GROUP BY track_key"
+    ))
+    db.session.execute(text(
+        "INSERT INTO platform_play_count (platform, plays) "
+        "SELECT COALESCE(platform, 'unknown') AS name, COUNT(*) FROM song_history GROUP BY name"
+    ))
+    db.session.execute(text(
+        "INSERT INTO daily_play_count (day, plays) "
+        "SELECT date(played_at) AS day, COUNT(*) FROM song_history GROUP BY day"
+    ))
+    db.session.commit()
+
+def top_tracks(limit):
+    rows = TrackPlayCount.query.order_by(TrackPlayCount.plays.desc()).limit(limit).all()
+    return [
+        {'title': row.title, 'url': row.url, 'platform': row.platform, 'plays': row.plays}
+        for row in rows
+    ]
+
+def top_platforms():
+    rows = PlatformPlayCount.query.order_by(PlatformPlayCount.plays.desc()).all()
+    return [{'platform': row.platform, 'plays': row.plays} for row in rows]
+
+def daily_plays(days):
+    # Plays per day for the last `days` days, oldest first, with empty days filled in
+    today = datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+    counts = dict(db.session.query(DailyPlayCount.day, DailyPlayCount.plays).filter(DailyPlayCount.day >= first))
+    return [
+        {'day': (first + timedelta(days=offset)).isoformat(), 'plays': counts.get(first + timedelta(days=offset), 0)}
+        for offset in range(days)
+    ]
+
+def total_plays():
+    return db.session.query(func.coalesce(func.sum(DailyPlayCount.plays), 0)).scalar()
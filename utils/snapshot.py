@@ -0,0 +1,51 @@
+import json
+import os
+import time
+
+# Periodic snapshot of every guild's playback state, so a crash or deploy doesn't wipe
+# the queues. Queue entries are stored as metadata only (no stream URLs).
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', os.path.join('instance', 'playback_snapshot.json'))
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 15)) # seconds
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', 15 * 60)) # older snapshots aren't restored
+RESTORE_STAGGER = float(os.getenv('RESTORE_STAGGER', 1.0)) # seconds between guild reconnects
+# Set by launcher.py: how many times in a row the bot exited shortly after starting.
+# Past RESTORE_MAX_CRASHES the snapshot is skipped in case restoring it is what crashes.
+RESTORE_MAX_CRASHES = 3
+
+def write_snapshot(state, path=SNAPSHOT_PATH):
+    # Write to a temp file and rename, so a crash mid-write never leaves a broken snapshot
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'saved_at': time.time(), 'guilds': state}, f)
+    os.replace(tmp_path, path)
+
+def read_snapshot(path=SNAPSHOT_PATH):
+    try:
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if time.time() - snapshot.get('saved_at', 0) > SNAPSHOT_MAX_AGE:
+        return {}
+    return snapshot.get('guilds', {})
+
+def restore_allowed():
+    return int(os.getenv('MUSIC_BOT_QUICK_CRASHES', 0)) < RESTORE_MAX_CRASHES
+
+class RestoredContext:
+    # Stand-in for a command Context when playback resumes without a command,
+    # with just the parts the Music cog uses
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.author = guild.me
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
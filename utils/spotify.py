@@ -0,0 +1,187 @@
+import aiohttp
+import asyncio
+import contextlib
+import json
+import re
+import time
+from utils.ytdl_source import Track
+
+# Spotify pages are scraped without the Web API, so no client credentials are needed.
+# Single tracks: the <title> of the track page ("Song - song by Artist | Spotify").
+# Playlists/albums: the embed page, which ships its track list as JSON in __NEXT_DATA__.
+SPOTIFY_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+SPOTIFY_TIMEOUT = 10 # seconds per request
+SPOTIFY_CACHE_TTL = 6 * 60 * 60 # Spotify URL -> search queries
+MATCH_CACHE_TTL = 60 * 60 # search query -> resolved YouTube match
+SPOTIFY_CONCURRENCY = 4 # playlist entries resolved at once
+SPOTIFY_LOOKAHEAD = 5 # queued entries matched ahead of time, counted from the front
+SPOTIFY_MAX_TRACKS = 500
+
+SPOTIFY_URL_RE = re.compile(r'open\.spotify\.com/(?:intl-[a-z]+/)?(track|playlist|album)/([A-Za-z0-9]+)')
+
+class TTLCache:
+    def __init__(self, ttl, maxsize=2048):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {} # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        if len(self._data) >= self.maxsize:
+            # Drop the oldest insertion; dicts keep insertion order
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+def is_spotify_url(url):
+    return SPOTIFY_URL_RE.search(url) is not None
+
+def is_placeholder(track):
+    # A Track.from_search entry, looked up by its title (flat playlist entries have a page URL)
+    return track.data.get('webpage_url', '').startswith('ytsearch:')
+
+# BeautifulSoup is imported on first use rather than at bot startup
+def parse_track_title(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    title_tag = soup.find('title')
+    if not title_tag:
+        return None
+    # Title usually looks like "Song Name - Song by Artist | Spotify"
+    return title_tag.get_text().replace(" | Spotify", "")
+
+def parse_embed_track_list(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    script = soup.find('script', id='__NEXT_DATA__')
+    if not script or not script.string:
+        return []
+    entity = json.loads(script.string)['props']['pageProps']['state']['data']['entity']
+    queries = []
+    for item in entity.get('trackList', []):
+        title = item.get('title')
+        if title:
+            # subtitle holds the artist names
+            queries.append(f"{title} {item.get('subtitle', '')}".strip())
+    return queries
+
+class SpotifyResolver:
+    def __init__(self):
+        self._session = None
+        self.queries = TTLCache(SPOTIFY_CACHE_TTL)
+        self.matches = TTLCache(MATCH_CACHE_TTL)
+        self._semaphore = asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+        self._tasks = {} # guild_id -> {Track: task matching it ahead of time}
+
+    def get_session(self):
+        # One pooled session for every Spotify request
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=SPOTIFY_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=SPOTIFY_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self):
+        for guild_id in list(self._tasks):
+            self.cancel(guild_id)
+        if self._session is not None:
+            await self._session.close()
+
+    async def fetch(self, url):
+        async with self.get_session().get(url) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def search_queries(self, url, *, loop=None):
+        # Spotify URL -> list of YouTube search queries (one per track)
+        loop = loop or asyncio.get_event_loop()
+        cached = self.queries.get(url)
+        if cached is not None:
+            return cached
+
+        kind, spotify_id = SPOTIFY_URL_RE.search(url).groups()
+        if kind == 'track':
+            html = await self.fetch(url)
+            title = await loop.run_in_executor(None, parse_track_title, html)
+            queries = [title] if title else []
+        else:
+            html = await self.fetch(f'https://open.spotify.com/embed/{kind}/{spotify_id}')
+            queries = await loop.run_in_executor(None, parse_embed_track_list, html)
+            queries = queries[:SPOTIFY_MAX_TRACKS]
+
+        if queries:
+            self.queries.set(url, queries)
+        return queries
+
+    async def resolve(self, track, *, loop=None, urgent=False):
+        # Fill in a placeholder Track with its YouTube match, reusing a cached one if possible.
+        # urgent: the track is starting now, so it doesn't wait behind lookahead matches.
+        if track.resolved:
+            return track
+        query = track.title
+        match = self.matches.get(query)
+        if match is not None:
+            track.update(match)
+            return track
+        async with contextlib.nullcontext() if urgent else self._semaphore:
+            # Another entry with the same query may have finished while we waited
+            match = self.matches.get(query)
+            if match is not None:
+                track.update(match)
+            else:
+                await track.refresh(loop=loop)
+                self.matches.set(query, track.data)
+        return track
+
+    def resolve_ahead(self, guild_id, tracks, *, loop=None):
+        # Match the Spotify entries among the next few in a guild's queue, so they are
+        # ready by the time they start. Called whenever the front of the queue changes;
+        # entries further back wait their turn, and an entry that reaches the head
+        # first is resolved on demand instead.
+        loop = loop or asyncio.get_event_loop()
+        pending = self._tasks.setdefault(guild_id, {})
+        for track in tracks:
+            if track.resolved or track in pending or not is_placeholder(track):
+                continue
+            task = loop.create_task(self._resolve_quietly(track, loop))
+            pending[track] = task
+            task.add_done_callback(lambda task, track=track: self._done(guild_id, track, task))
+        if not pending:
+            del self._tasks[guild_id]
+
+    def _done(self, guild_id, track, task):
+        pending = self._tasks.get(guild_id)
+        if pending is not None and pending.get(track) is task:
+            del pending[track]
+            if not pending:
+                del self._tasks[guild_id]
+
+    def cancel(self, guild_id):
+        # The guild's queue was cleared or the bot left: stop matching its entries
+        for task in self._tasks.pop(guild_id, {}).values():
+            task.cancel()
+
+    async def _resolve_quietly(self, track, loop):
+        try:
+            await self.resolve(track, loop=loop)
+        except Exception as e:
+            print(f"Spotify match failed for {track.title}: {e}")
+
+    async def tracks_from_url(self, url, *, requester=None, loop=None):
+        queries = await self.search_queries(url, loop=loop)
+        tracks = [Track.from_search(query, requester=requester) for query in queries]
+        if len(tracks) == 1:
+            # A single song is resolved right away so the embed can show the real title.
+            # Playlist entries are matched once they near the front (resolve_ahead).
+            await self.resolve(tracks[0], loop=loop)
+        return tracks
+
+spotify = SpotifyResolver()
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Where the hash of the last synced application command tree is kept. bot.py only
+# calls tree.sync() (a Discord API round-trip) when the tree has changed since.
+COMMAND_TREE_HASH_PATH = os.getenv('COMMAND_TREE_HASH_PATH', os.path.join('instance', 'command_tree.sha256'))
+
+class StartupTimer:
+    # Wall time per startup phase, measured from `started` (taken at the top of bot.py,
+    # before its imports). report() is printed once the bot is ready.
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = [] # (name, seconds)
+        self.total = None
+        self._last = self.started
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+            self._last = time.perf_counter()
+
+    def mark(self, name):
+        # A phase that ran from the previous phase (or mark) until now
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def finish(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self.started
+        return self.total
+
+    def report(self):
+        parts = [f'{name} {seconds * 1000:.0f} ms' for name, seconds in self.phases]
+        return f"Startup took {self.finish():.2f}s: " + ' • '.join(parts)
+
+def command_tree_hash(tree, application_id):
+    payload = json.dumps([command.to_dict(tree) for command in tree.get_commands()], sort_keys=True)
+    return hashlib.sha256(f'{application_id}:{payload}'.encode()).hexdigest()
+
+def read_command_tree_hash():
+    try:
+        with open(COMMAND_TREE_HASH_PATH) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_command_tree_hash(digest):
+    os.makedirs(os.path.dirname(COMMAND_TREE_HASH_PATH) or '.', exist_ok=True)
+    with open(COMMAND_TREE_HASH_PATH, 'w') as f:
+        f.write(digest)
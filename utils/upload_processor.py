@@ -0,0 +1,173 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from models import db, UploadedFile
+from utils import metrics
+
+# Uploaded files are probed and transcoded in the background, off the request: ffprobe
+# reads duration and tags, FFmpeg normalises loudness and encodes a compact Opus copy.
+# !play file <name> plays that copy (or the raw upload while it isn't ready yet).
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2)) # concurrent FFmpeg transcodes
+UPLOAD_OPUS_BITRATE = os.getenv('UPLOAD_OPUS_BITRATE', '128k')
+# EBU R128 target, the same ballpark as streaming services
+UPLOAD_LOUDNORM = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+UPLOAD_TIMEOUT = 600 # seconds per FFmpeg run
+
+class UploadProcessor:
+    def __init__(self, app, *, workers=UPLOAD_WORKERS):
+        self.app = app
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._resubmit = set() # replaced by a new upload while being processed
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def upload_folder(self):
+        return self.app.config['UPLOAD_FOLDER']
+
+    @property
+    def transcode_folder(self):
+        return self.app.config['TRANSCODE_FOLDER']
+
+    def _pool(self):
+        # Created on first use, and again in a forked child (gunicorn workers): the
+        # parent's threads don't exist there
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='upload')
+                self._pid = os.getpid()
+                self._pending = set()
+                self._resubmit = set()
+            return self._executor
+
+    def submit(self, filename):
+        # Queue a file from the uploads folder; replaces what was known about an older file of that name
+        pool = self._pool()
+        with self._lock:
+            if filename in self._pending:
+                self._resubmit.add(filename)
+                return
+            self._pending.add(filename)
+        with self.app.app_context():
+            upload = db.session.get(UploadedFile, filename) or UploadedFile(filename=filename)
+            upload.status = 'pending'
+            upload.error = None
+            upload.updated_at = datetime.utcnow()
+            db.session.add(upload)
+            db.session.commit()
+        pool.submit(self._process, filename)
+
+    def resume(self):
+        # On startup: process uploads that have no finished transcode (including files
+        # uploaded before this existed) and forget files that were deleted
+        os.makedirs(self.upload_folder, exist_ok=True)
+        files = {name for name in os.listdir(self.upload_folder) if not name.startswith('.')}
+        with self.app.app_context():
+            known = {upload.filename: upload for upload in UploadedFile.query}
+            for filename, upload in known.items():
+                if filename not in files:
+                    self._remove_opus(upload.opus_path)
+                    db.session.delete(upload)
+            db.session.commit()
+        for filename in sorted(files):
+            upload = known.get(filename)
+            if upload is None or upload.status == 'pending':
+                self.submit(filename)
+
+    def _process(self, filename):
+        source = os.path.join(self.upload_folder, filename)
+        started = time.perf_counter()
+        try:
+            info = probe(source)
+            opus_path = os.path.join(self.transcode_folder, f'{filename}.opus')
+            transcode(source, opus_path)
+            with self.app.app_context():
+                upload = db.session.get(UploadedFile, filename) or UploadedFile(filename=filename)
+                upload.title = info['title']
+                upload.artist = info['artist']
+                upload.duration = info['duration']
+                upload.size = os.path.getsize(source)
+                upload.opus_path = opus_path
+                upload.status = 'ready'
+                upload.error = None
+                upload.updated_at = datetime.utcnow()
+                db.session.add(upload)
+                db.session.commit()
+            self.processed += 1
+            metrics.upload_processing_seconds.observe(time.perf_counter() - started)
+        except Exception as e:
+            self.failed += 1
+            print(f"Failed to process upload {filename}: {e}")
+            with self.app.app_context():
+                upload = db.session.get(UploadedFile, filename)
+                if upload is not None:
+                    upload.status = 'failed'
+                    upload.error = str(e)[:255]
+                    upload.updated_at = datetime.utcnow()
+                    db.session.commit()
+        finally:
+            with self._lock:
+                self._pending.discard(filename)
+                resubmit = filename in self._resubmit
+                self._resubmit.discard(filename)
+            if resubmit:
+                self.submit(filename)
+
+    def _remove_opus(self, path):
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'pending': len(self._pending), 'processed': self.processed, 'failed': self.failed}
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def probe(path):
+    # Duration and the title/artist tags (tag names are case-insensitive across formats)
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:format_tags', '-of', 'json', path],
+        capture_output=True, text=True, timeout=60,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or 'ffprobe failed')
+    fmt = json.loads(result.stdout).get('format', {})
+    tags = {key.lower(): value for key, value in fmt.get('tags', {}).items()}
+    duration = fmt.get('duration')
+    return {
+        'title': (tags.get('title') or '').strip()[:255] or None,
+        'artist': (tags.get('artist') or tags.get('album_artist') or '').strip()[:255] or None,
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+    }
+
+def transcode(source, path):
+    # Written to a temporary name first so a half-written file is never played
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = f'{path}.{os.getpid()}.part'
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', source, '-vn', '-map_metadata', '-1',
+             '-af', UPLOAD_LOUDNORM, '-ar', '48000', '-c:a', 'libopus', '-b:a', UPLOAD_OPUS_BITRATE,
+             '-f', 'opus', '-y', part],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=UPLOAD_TIMEOUT,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or 'ffmpeg failed')
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
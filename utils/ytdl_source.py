@@ -1,11 +1,15 @@
 import discord
-import yt_dlp
-import asyncio
-import requests
-from bs4 import BeautifulSoup
-
-# Suppress noise about console usage from errors
-yt_dlp.utils.bug_reports_message = lambda *args, **kwargs: ''
+import os
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from utils.resolver import ResolverPool, load_yt_dlp
+from utils.metadata_cache import metadata_cache
+from utils.audio_cache import audio_cache
+from utils.loop_buffer import loop_buffer
+from utils.loudness import loudness
+from utils import metrics
 
 ytdl_format_options = {
     'format': 'bestaudio/best',
@@ -28,56 +32,388 @@ ytdl_format_options = {
     }
 }
 
+# How much of a stream FFmpeg reads to detect its format before it starts decoding. Audio
+# streams are identified within the first few KB; a big probe only delays the first frame
+# (and every seek, which starts a new FFmpeg).
+FFMPEG_PROBESIZE = os.getenv('FFMPEG_PROBESIZE', '256K')
+
 ffmpeg_options = {
     'options': '-vn',
-    # Improved options for stability and buffering + FORCE START AT 00:00:00
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -probesize 200M -ss 00:00:00 -user_agent "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36" -headers "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"' 
+    # Improved options for stability and buffering. A start offset (-ss, input-side so
+    # FFmpeg skips straight there) is added per source by build_ffmpeg_options
+    'before_options': f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -probesize {FFMPEG_PROBESIZE} -user_agent "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36" -headers "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"' 
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# Playback mode: 'pcm' decodes to PCM and scales volume in Python (PCMVolumeTransformer),
+# 'opus' has FFmpeg apply volume/normalisation and emit Opus packets that are sent as-is
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'pcm').lower()
+DEFAULT_VOLUME = float(os.getenv('DEFAULT_VOLUME', 0.5))
+OPUS_BITRATE = int(os.getenv('OPUS_BITRATE', 128))
+# Apply FFmpeg's single-pass loudnorm filter to every track
+LOUDNORM = os.getenv('FFMPEG_LOUDNORM', '').lower() in ('1', 'true', 'yes')
+
+# Each frame handed to discord.py is 20 ms of audio
+FRAME_SECONDS = 0.02
+
+# Every extract_info call goes through this pool (one YoutubeDL per worker thread)
+resolver = ResolverPool(ytdl_format_options)
+
+# Only these keys from extract_info are kept on a queued Track. The full info dict
+# (formats, subtitles, heatmaps...) can be hundreds of KB per song.
+TRACK_FIELDS = ('id', 'title', 'url', 'webpage_url', 'uploader', 'duration', 'thumbnail', 'extractor', 'acodec', 'http_headers', 'upload')
+
+# Stream URLs are signed and expire (googlevideo links carry an `expire=` param).
+# A queued track is re-resolved when it starts if less than STREAM_URL_MARGIN seconds
+# are left, or after STREAM_URL_TTL seconds for extractors that don't advertise an expiry.
+STREAM_URL_MARGIN = 60
+STREAM_URL_TTL = 30 * 60
+
+_ytdl = None
+
+def get_ytdl():
+    # Only needed for prepare_filename; built on first use to keep this module cheap to import
+    global _ytdl
+    if _ytdl is None:
+        _ytdl = load_yt_dlp().YoutubeDL(ytdl_format_options)
+    return _ytdl
+
+async def extract(query, *, guild_id=None, need_stream=False):
+    # Metadata for a query, from the persistent cache when possible. need_stream=True
+    # (when a track is about to play) only accepts cache hits with a usable stream URL.
+    data = await metadata_cache.run(metadata_cache.get, query, need_stream=need_stream)
+    if data is not None:
+        return data
+    with metrics.resolve_seconds.time():
+        data = await resolver.extract_info(query, guild_id=guild_id)
+    if 'entries' in data:
+        # take first item from a playlist
+        data = data['entries'][0]
+    # Not waited for: the track can start while the cache is written
+    metadata_cache.run(metadata_cache.put, query, data)
+    return data
+
+class Track:
+    # A queued song: metadata and requester only, no FFmpeg process.
+    # YTDLSource.from_track turns it into a playable source when its turn comes.
+    # __slots__ keeps big queues (e.g. a 500-song playlist of placeholders) compact.
+    __slots__ = ('data', 'requester', 'local', 'resolved_at')
+
+    def __init__(self, data, *, requester=None, local=False):
+        self.data = {key: data[key] for key in TRACK_FIELDS if key in data}
+        self.requester = requester
+        self.local = local
+        self.resolved_at = time.time()
+
+    @property
+    def title(self):
+        return self.data.get('title')
+
+    @property
+    def url(self):
+        return self.data.get('url')
+
+    @property
+    def guild_id(self):
+        # Resolver requests are queued per guild; the requester is a Member when there is one
+        guild = getattr(self.requester, 'guild', None)
+        return guild.id if guild else None
+
+    @property
+    def resolved(self):
+        return 'url' in self.data
+
+    @classmethod
+    def from_file(cls, filepath, *, requester=None, upload=None):
+        # upload: the upload processor's record of the file (web_app.upload_info). Once
+        # it is transcoded the Opus copy is played instead, with its tags and duration.
+        filename = os.path.basename(filepath)
+        data = {
+            'title': filename,
+            'upload': filename,
+            'url': filepath,
+            'webpage_url': 'local',
+            'extractor': 'local_file',
+            'uploader': 'Server',
+        }
+        if upload and upload['status'] == 'ready' and os.path.exists(upload['opus_path']):
+            data['url'] = upload['opus_path']
+            data['acodec'] = 'opus'
+            data['title'] = upload['title'] or filename
+            data['uploader'] = upload['artist'] or 'Server'
+            if upload['duration']:
+                data['duration'] = upload['duration']
+        return cls(data, requester=requester, local=True)
+
+    @classmethod
+    def from_search(cls, query, *, requester=None):
+        # Placeholder for a song that hasn't been looked up yet (e.g. a Spotify playlist
+        # entry). It has no stream URL, so it is resolved at the latest when it starts.
+        data = {'title': query, 'webpage_url': f'ytsearch:{query}'}
+        return cls(data, requester=requester)
+
+    @classmethod
+    def from_flat(cls, entry, *, requester=None):
+        # Placeholder from a flat playlist listing (extract_flat): the entry's 'url' is its
+        # page, not a stream, so it only becomes webpage_url and is resolved when needed
+        page_url = entry.get('webpage_url') or entry.get('url')
+        if entry.get('ie_key') == 'Youtube' and entry.get('id'):
+            page_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        data = {
+            'id': entry.get('id'),
+            'title': entry.get('title') or page_url,
+            'webpage_url': page_url,
+            'duration': entry.get('duration'),
+            'uploader': entry.get('uploader') or entry.get('channel'),
+        }
+        return cls({key: value for key, value in data.items() if value is not None}, requester=requester)
+
+    @classmethod
+    async def from_url(cls, url, *, loop=None, requester=None, stream=True):
+        guild = getattr(requester, 'guild', None)
+        guild_id = guild.id if guild else None
+        if stream:
+            # A cache hit may come without a stream URL; it is then fetched when the track starts
+            return cls(await extract(url, guild_id=guild_id), requester=requester)
+
+        data = await resolver.extract_info(url, guild_id=guild_id, download=True)
+        if 'entries' in data:
+            # take first item from a playlist
+            data = data['entries'][0]
+        # The info dict may be shared with other callers of the same query
+        data = dict(data, url=get_ytdl().prepare_filename(data))
+        return cls(data, requester=requester, local=True)
+
+    def to_dict(self):
+        # Metadata only: stream URLs will have expired by the time this is read back
+        data = {key: value for key, value in self.data.items() if key not in ('url', 'http_headers')}
+        if self.local:
+            data['url'] = self.url # a file path, still valid
+        return {'data': data, 'requester_id': getattr(self.requester, 'id', None), 'local': self.local}
+
+    @classmethod
+    def from_dict(cls, entry, *, requester=None):
+        return cls(entry['data'], requester=requester, local=entry.get('local', False))
+
+    def update(self, data):
+        self.data = {key: data[key] for key in TRACK_FIELDS if key in data}
+        self.resolved_at = time.time()
+
+    def is_stale(self):
+        if self.local:
+            return False
+        url = self.url
+        if not url:
+            return True
+        expire = parse_qs(urlparse(url).query).get('expire')
+        if expire:
+            try:
+                return int(expire[0]) - time.time() < STREAM_URL_MARGIN
+            except ValueError:
+                pass
+        return time.time() - self.resolved_at > STREAM_URL_TTL
+
+    async def refresh(self, *, loop=None):
+        # Re-run extraction on the page URL to get a fresh signed stream URL
+        page_url = self.data.get('webpage_url')
+        self.update(await extract(page_url, guild_id=self.guild_id, need_stream=True))
+
+def build_ffmpeg_options(local, *, volume=None, start=0, gain=0):
+    # volume=None leaves the level alone (PCM mode scales it in Python instead).
+    # gain: the track's static loudness correction in dB, applied with the volume.
+    before_options = f'-ss {start:.2f}' if start else ''
+    if not local:
+        before_options = f"{before_options} {ffmpeg_options['before_options']}".strip()
+
+    filters = []
+    level = (1.0 if volume is None else volume) * 10 ** (gain / 20)
+    if abs(level - 1.0) >= 0.005:
+        filters.append(f'volume={level:.2f}')
+    if LOUDNORM:
+        filters.append('loudnorm')
+
+    options = ffmpeg_options['options']
+    if filters:
+        options += f' -af {",".join(filters)}'
+    return {'before_options': before_options, 'options': options}
+
+async def playback_input(track, *, loop=None, guild_id=None):
+    # What FFmpeg should read for a track: the audio cache copy or the guild's loop
+    # buffer copy when there is one, otherwise the stream URL (refreshed first if it
+    # has expired)
+    cached_path = audio_cache.path_for(track) or loop_buffer.path_for(guild_id, track)
+    if cached_path:
+        return cached_path, True
+    if track.is_stale():
+        await track.refresh(loop=loop)
+    return track.url, track.local
+
+# Running FFmpeg playback processes per guild, for the per-guild budget in the Music cog
+ffmpeg_by_guild = Counter()
+_ffmpeg_lock = threading.Lock()
+
+def ffmpeg_count(guild_id):
+    with _ffmpeg_lock:
+        return ffmpeg_by_guild[guild_id]
+
+class PrimedAudio(discord.AudioSource):
+    # Wraps an FFmpeg source so its first frame can be pulled ahead of time.
+    # Once FFmpeg has produced a frame the HTTP connection is open and the pipe
+    # is filling, so playback can start without waiting on the network.
+    # Also counts frames handed out, which gives the playback position.
+    def __init__(self, source, *, start=0, guild_id=None):
+        self.source = source
+        self.start = start
+        self.guild_id = guild_id
+        self.frames = 0
+        self._primed = None
+        # FFmpeg was spawned just before this wrapper was made
+        self._spawned_at = time.perf_counter()
+        self._cleaned_up = False
+        self._replaced = None # source this one took over from, until it is read
+        metrics.ffmpeg_processes.inc()
+        with _ffmpeg_lock:
+            ffmpeg_by_guild[guild_id] += 1
+
+    @property
+    def position(self):
+        return self.start + self.frames * FRAME_SECONDS
+
+    def prime(self):
+        # Blocks until FFmpeg produces its first frame: run it in an executor
+        if self._primed is None:
+            self._primed = self._read()
+
+    def take_over(self, previous):
+        # Swapped in for a playing source. The voice player reads without a lock, so a
+        # read of the previous one may still be in flight: killing its FFmpeg now could
+        # hand the player an empty frame and end the track. It is cleaned up once the
+        # player reads from this source instead.
+        self._replaced = previous
+
+    def _release_replaced(self):
+        previous, self._replaced = self._replaced, None
+        if previous is not None:
+            previous.cleanup()
+
+    def _read(self):
+        frame = self.source.read()
+        if self._spawned_at is not None:
+            metrics.first_frame_seconds.observe(time.perf_counter() - self._spawned_at)
+            self._spawned_at = None
+        return frame
+
+    def read(self):
+        if self._primed is not None:
+            frame, self._primed = self._primed, None
+        else:
+            frame = self._read()
+        if frame:
+            self.frames += 1
+        if self._replaced is not None:
+            self._release_replaced()
+        return frame
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        # discord.py and our own source swaps may both clean up the same source
+        self._release_replaced()
+        if not self._cleaned_up:
+            self._cleaned_up = True
+            metrics.ffmpeg_processes.dec()
+            with _ffmpeg_lock:
+                ffmpeg_by_guild[self.guild_id] -= 1
+                if ffmpeg_by_guild[self.guild_id] <= 0:
+                    del ffmpeg_by_guild[self.guild_id]
+        self.source.cleanup()
 
 class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+    def __init__(self, source, *, data, volume=0.5, start=0, guild_id=None):
+        super().__init__(PrimedAudio(source, start=start, guild_id=guild_id), volume)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
 
+    @property
+    def position(self):
+        return self.original.position
+
+    def prime(self):
+        self.original.prime()
+
+    def take_over(self, previous):
+        self.original.take_over(previous)
+
+    @classmethod
+    async def from_track(cls, track, *, loop=None, volume=DEFAULT_VOLUME, start=0, guild_id=None, gain=0):
+        # Called when the track actually starts: this is where FFmpeg gets spawned
+        source_path, local = await playback_input(track, loop=loop, guild_id=guild_id)
+        source = discord.FFmpegPCMAudio(source_path, **build_ffmpeg_options(local, start=start, gain=gain))
+        player = cls(source, data=track.data, volume=volume, start=start, guild_id=guild_id)
+        player.requester = track.requester
+        return player
+
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=True):
-        loop = loop or asyncio.get_event_loop()
-        
-        # Check for Spotify
-        if "open.spotify.com" in url:
-            try:
-                # Basic scraping to get title
-                # We need a User-Agent, otherwise Spotify might block or return limited info
-                headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-                response = requests.get(url, headers=headers)
-                
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    title_tag = soup.find('title')
-                    if title_tag:
-                        # Title usually looks like "Song Name - Song by Artist | Spotify"
-                        page_title = title_tag.get_text()
-                        # Clean up a bit to get a good search query
-                        search_query = page_title.replace(" | Spotify", "")
-                        # Force a youtube search
-                        url = f"ytsearch:{search_query}"
-            except Exception as e:
-                print(f"Spotify extraction failed: {e}")
-                # Fallback: let yt-dlp try or fail
-
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+        track = await Track.from_url(url, loop=loop, stream=stream)
+        return await cls.from_track(track, loop=loop)
 
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+class YTDLOpusSource(discord.AudioSource):
+    # Opus playback: FFmpeg applies volume/normalisation and encodes to Opus (or copies
+    # the stream through when it already is Opus and needs no filtering), so the bot
+    # only forwards packets. Volume is fixed per source; changing it means building a
+    # new source at the current position.
+    def __init__(self, source, *, data, volume=0.5, start=0, guild_id=None):
+        self.original = PrimedAudio(source, start=start, guild_id=guild_id)
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self.volume = volume
+
+    @property
+    def position(self):
+        return self.original.position
+
+    def prime(self):
+        self.original.prime()
+
+    def take_over(self, previous):
+        self.original.take_over(previous)
+
+    def read(self):
+        return self.original.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    @classmethod
+    async def from_track(cls, track, *, loop=None, volume=DEFAULT_VOLUME, start=0, guild_id=None, gain=0):
+        source_path, local = await playback_input(track, loop=loop, guild_id=guild_id)
+        options = build_ffmpeg_options(local, volume=volume, start=start, gain=gain)
+        codec = None
+        # Audio cache files are always Opus
+        is_opus = track.data.get('acodec') == 'opus' or (local and not track.local)
+        if is_opus and '-af' not in options['options']:
+            codec = 'copy'
+        source = discord.FFmpegOpusAudio(source_path, bitrate=OPUS_BITRATE, codec=codec, **options)
+        player = cls(source, data=track.data, volume=volume, start=start, guild_id=guild_id)
+        player.requester = track.requester
+        return player
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        
-        # Inject the User-Agent directly into the filename URL if possible, or rely on before_options
-        # Some versions of FFmpeg need headers passed differently
-        
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+async def create_player(track, *, loop=None, volume=DEFAULT_VOLUME, start=0, guild_id=None):
+    # Build the playable source for a Track in the configured PLAYBACK_MODE.
+    # guild_id is what its FFmpeg process counts against (see ffmpeg_count).
+    source_cls = YTDLOpusSource if PLAYBACK_MODE == 'opus' else YTDLSource
+    from utils.spotify import spotify, is_placeholder
+    if is_placeholder(track) and not track.resolved:
+        # A Spotify entry that got here before resolve_ahead did: look it up through the
+        # resolver so its match is cached for the next time the song is queued
+        await spotify.resolve(track, loop=loop, urgent=True)
+    # The live loudnorm filter already evens out the level
+    gain = 0 if LOUDNORM else await loudness.gain_for(track)
+    with metrics.player_start_seconds.time():
+        return await source_cls.from_track(track, loop=loop, volume=volume, start=start, guild_id=guild_id, gain=gain)
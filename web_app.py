@@ -1,23 +1,92 @@
 import os
-from flask import Flask, redirect, url_for, render_template, request, flash, session
+import re
+import sqlite3
+import hashlib
+import tempfile
+from datetime import datetime
+from flask import Flask, Request, redirect, url_for, render_template, request, flash, session, make_response, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, and_, or_, text, inspect
+from sqlalchemy.engine import Engine
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from requests_oauthlib import OAuth2Session
-from models import db, User, SongHistory
+from models import db, User, SongHistory, TrackPlayCount, UploadedFile
+from utils.history_writer import HistoryWriter
+from utils.upload_processor import UploadProcessor
+from utils import rollups, metrics
 from werkzeug.utils import secure_filename
-from threading import Thread
+from threading import Event
 
 # Allow HTTP for OAuth locally
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
+class StreamingUploadRequest(Request):
+    # Multipart file parts are written in chunks, as they arrive, to a temporary file in
+    # the uploads folder instead of being spooled in memory or /tmp first. /upload then
+    # only has to rename the file into place.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        incoming = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+        os.makedirs(incoming, exist_ok=True)
+        stream = tempfile.NamedTemporaryFile('wb+', dir=incoming, suffix='.part', delete=False)
+        self.__dict__.setdefault('incoming_files', []).append(stream)
+        return stream
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except BaseException:
+            # Client disconnected or upload too large part way through: request.files
+            # is never set, so the teardown below can't find the partial file
+            self.remove_incoming_files()
+            raise
+
+    def remove_incoming_files(self):
+        # Temporary files that weren't moved into place by /upload
+        for stream in self.__dict__.pop('incoming_files', []):
+            stream.close()
+            try:
+                os.remove(stream.name)
+            except FileNotFoundError:
+                pass
+
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'super_secret_key_change_me')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///music_bot.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
+# Opus transcodes of the uploads, made by the upload processor
+app.config['TRANSCODE_FOLDER'] = os.path.join('uploads', '.opus')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max upload
+# The bot and a standalone web process (wsgi.py) share the SQLite file: wait for locks instead of failing
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+# Static files can be cached by browsers; templates are compiled once
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 24 * 60 * 60
+app.config['TEMPLATES_AUTO_RELOAD'] = False
 
 db.init_app(app)
+history_writer = HistoryWriter(app)
+# Set once init_db has created the tables, for the bot's tasks that query them at startup
+db_ready = Event()
+upload_processor = UploadProcessor(app)
+metrics.registry.gauge('music_history_pending', 'Plays waiting to be written to song_history', callback=lambda: history_writer.pending)
+metrics.registry.counter('music_history_written_total', 'Plays written to song_history', callback=lambda: history_writer.written)
+metrics.registry.counter('music_history_dropped_total', 'Plays lost to failed history writes', callback=lambda: history_writer.dropped)
+metrics.registry.gauge('music_uploads_pending', 'Uploads waiting to be probed and transcoded', callback=lambda: upload_processor.stats()['pending'])
+metrics.registry.counter('music_uploads_processed_total', 'Uploads probed and transcoded', callback=lambda: upload_processor.processed)
+metrics.registry.counter('music_uploads_failed_total', 'Uploads that could not be processed', callback=lambda: upload_processor.failed)
+# /metrics is open unless a token is set; scrapers then send it as a bearer token
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the dashboard read while the bot's history writer commits
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -33,9 +102,23 @@ API_BASE_URL = 'https://discord.com/api'
 def load_user(user_id):
     return User.query.get(user_id)
 
+# The landing page is the same for every anonymous visitor, so it is rendered once
+_anonymous_index = None
+
+def cacheable(response):
+    # Let browsers revalidate with If-None-Match and get a 304 instead of the whole page
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    global _anonymous_index
+    if current_user.is_authenticated or session.get('_flashes'):
+        return cacheable(make_response(render_template('index.html')))
+    if _anonymous_index is None:
+        _anonymous_index = render_template('index.html')
+    return cacheable(make_response(_anonymous_index))
 
 @app.route('/login')
 def login():
@@ -80,12 +163,173 @@ def callback():
         flash(f'Authentication failed: {e}')
         return redirect(url_for('index'))
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+# History matches are read newest first straight from the full-text index; this many
+# rows per requested result are scanned so repeats of the same song can be folded
+SEARCH_SCAN_FACTOR = 5
+STATS_TOP_TRACKS = 20
+STATS_DAYS = 30
+
+# Listing of UPLOAD_FOLDER: (directory mtime, sorted file names). Cleared by /upload, and
+# the mtime check catches files added by other web workers or processes.
+_upload_listing = None
+
+def uploaded_files():
+    global _upload_listing
+    folder = app.config['UPLOAD_FOLDER']
+    mtime = os.stat(folder).st_mtime_ns
+    if _upload_listing is None or _upload_listing[0] != mtime:
+        _upload_listing = (mtime, sorted(name for name in os.listdir(folder) if not name.startswith('.')))
+        sync_upload_index(_upload_listing[1])
+    return _upload_listing[1]
+
+def parse_cursor(cursor):
+    # Cursors look like "<played_at ISO timestamp>_<id>" of the last row on the previous page
+    if not cursor:
+        return None
+    try:
+        played_at, history_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(played_at), int(history_id)
+    except ValueError:
+        abort(400)
+
+def history_page(user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    # Keyset pagination: seek past the cursor on the (user_id, played_at) index
+    # instead of OFFSET, so deep pages cost the same as the first one
+    query = SongHistory.query.filter_by(user_id=user_id)
+    if before is not None:
+        played_at, history_id = before
+        query = query.filter(or_(
+            SongHistory.played_at < played_at,
+            and_(SongHistory.played_at == played_at, SongHistory.id < history_id),
+        ))
+    rows = query.order_by(SongHistory.played_at.desc(), SongHistory.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last.played_at.isoformat()}_{last.id}"
+    return rows, next_cursor
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    history = SongHistory.query.filter_by(user_id=current_user.id).order_by(SongHistory.played_at.desc()).limit(50).all()
-    files = os.listdir(app.config['UPLOAD_FOLDER'])
-    return render_template('dashboard.html', history=history, files=files)
+    history, next_cursor = history_page(current_user.id, parse_cursor(request.args.get('before')))
+    files = uploaded_files()
+    return cacheable(make_response(render_template('dashboard.html', history=history, files=files, next_cursor=next_cursor)))
+
+@app.route('/api/history')
+@login_required
+def api_history():
+    before = request.args.get('before', '')
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    # The newest row changes whenever this user's history does, so it makes a cheap
+    # ETag: a matching If-None-Match is answered without loading the page. It is read
+    # in the page's own order, one seek on the (user_id, played_at) index (max(id)
+    # would scan every row of the user's).
+    latest = db.session.query(SongHistory.played_at, SongHistory.id).filter(
+        SongHistory.user_id == current_user.id
+    ).order_by(SongHistory.played_at.desc(), SongHistory.id.desc()).first()
+    etag = hashlib.sha1(f'{current_user.id}:{latest}:{before}:{limit}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        rows, next_cursor = history_page(current_user.id, parse_cursor(before), limit)
+        response = jsonify({'items': [row.to_dict() for row in rows], 'next': next_cursor})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def match_expression(terms):
+    # User input becomes a list of quoted FTS5 terms (implicitly ANDed), so quotes and
+    # operators in it can't break the query. The last word also matches as a prefix.
+    words = re.findall(r'\w+', terms)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+def search_history(user_id, terms, limit=SEARCH_LIMIT):
+    # Full-text search over one user's history, newest plays first, one result per song.
+    # The user ID is indexed too, so the MATCH itself only yields this user's plays: FTS5
+    # intersects their doclist with the title terms, walks it in rowid (= insertion)
+    # order and stops once enough rows matched, however many other users share the words.
+    expression = match_expression(terms)
+    if expression is None:
+        return []
+    expression = f'user_id : "{int(user_id)}" AND title : ({expression})'
+    with app.app_context():
+        rows = db.session.execute(text(
+            'SELECT h.title, h.url, h.platform, h.played_at FROM song_history_fts '
+            'JOIN song_history AS h ON h.id = song_history_fts.rowid '
+            'WHERE song_history_fts MATCH :expression AND h.user_id = :user_id '
+            'ORDER BY song_history_fts.rowid DESC LIMIT :scan'
+        ), {'expression': expression, 'user_id': str(user_id), 'scan': limit * SEARCH_SCAN_FACTOR}).all()
+    results = {}
+    for title, url, platform, played_at in rows:
+        key = title if url == 'local' else url
+        if key not in results:
+            results[key] = {'title': title, 'url': url, 'platform': platform, 'played_at': str(played_at)[:19]}
+            if len(results) == limit:
+                break
+    return list(results.values())
+
+def search_uploads(terms, limit=SEARCH_LIMIT):
+    expression = match_expression(terms)
+    if expression is None:
+        return []
+    uploaded_files()  # picks up files added or removed since the index was last synced
+    rows = db.session.execute(text(
+        'SELECT filename FROM upload_fts WHERE upload_fts MATCH :expression ORDER BY rank LIMIT :limit'
+    ), {'expression': expression, 'limit': limit}).all()
+    return [filename for filename, in rows]
+
+def sync_upload_index(files):
+    # Bring upload_fts in line with the uploads folder, touching only the differences
+    indexed = {filename for filename, in db.session.execute(text('SELECT filename FROM upload_fts'))}
+    current = set(files)
+    if indexed == current:
+        return
+    for filename in indexed - current:
+        db.session.execute(text('DELETE FROM upload_fts WHERE filename = :filename'), {'filename': filename})
+    for filename in current - indexed:
+        db.session.execute(text('INSERT INTO upload_fts (filename) VALUES (:filename)'), {'filename': filename})
+    db.session.commit()
+
+@app.route('/search')
+@login_required
+def search():
+    terms = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+    return jsonify({
+        'history': search_history(current_user.id, terms, limit),
+        'uploads': search_uploads(terms, limit),
+    })
+
+@app.route('/stats')
+@login_required
+def stats():
+    # Reads only the rollup tables (utils/rollups.py), never song_history itself
+    days = rollups.daily_plays(STATS_DAYS)
+    response = make_response(render_template(
+        'stats.html',
+        tracks=rollups.top_tracks(STATS_TOP_TRACKS),
+        platforms=rollups.top_platforms(),
+        days=days,
+        busiest_day=max(day['plays'] for day in days),
+        total_plays=rollups.total_plays(),
+    ))
+    return cacheable(response)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 @app.route('/upload', methods=['POST'])
 @login_required
@@ -101,38 +345,165 @@ def upload_file():
     
     if file:
         filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        if not filename:
+            flash('Invalid file name')
+            return redirect(url_for('dashboard'))
+        # Already on disk (see StreamingUploadRequest): move it into place
+        file.stream.close()
+        os.replace(file.stream.name, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        global _upload_listing
+        _upload_listing = None
+        uploaded_files()
+        # Probing and transcoding happen in the background
+        upload_processor.submit(filename)
         flash(f'File {filename} uploaded successfully')
         return redirect(url_for('dashboard'))
 
+@app.teardown_request
+def remove_incoming_files(exc):
+    # Temporary upload files that weren't moved into place, e.g. from a rejected request
+    request._get_current_object().remove_incoming_files()
+
 @app.route('/logout')
 def logout():
     logout_user()
     return redirect(url_for('index'))
 
-# Helper function for the bot to add history
+# Helper function for the bot to add history. It only queues the play; the
+# history writer thread inserts them in batches off the bot's event loop.
 def add_history(user_id, title, url, platform):
+    history_writer.add(user_id, title, url, platform)
+
+# Most played page URLs since `since`, for the bot's audio cache
+def top_played(since, min_plays, limit):
     with app.app_context():
-        # Ensure user exists (in case they haven't logged into web yet)
-        # Note: If user hasn't logged in, we might not have their username, so we create a placeholder or skip
-        user = User.query.get(user_id)
-        if not user:
-            # We can create a placeholder user
-            user = User(id=str(user_id), username="Unknown User", avatar_url="")
-            db.session.add(user)
-        
-        history = SongHistory(user_id=str(user_id), title=title, url=url, platform=platform)
-        db.session.add(history)
-        db.session.commit()
+        plays = func.count(SongHistory.id)
+        rows = (
+            db.session.query(SongHistory.url, plays)
+            .filter(SongHistory.played_at >= since, SongHistory.url != 'local')
+            .group_by(SongHistory.url)
+            .having(plays >= min_plays)
+            .order_by(plays.desc())
+            .limit(limit)
+            .all()
+        )
+        return {url: count for url, count in rows}
 
-def run():
+# Most played songs overall, from the rollups
+def top_tracks(limit):
+    with app.app_context():
+        return rollups.top_tracks(limit)
+
+# What the upload processor knows about an uploaded file, or None
+def upload_info(filename):
+    with app.app_context():
+        upload = db.session.get(UploadedFile, filename)
+        return upload.to_dict() if upload is not None else None
+
+def rebuild_rollups():
+    with app.app_context():
+        rollups.rebuild()
+
+def init_db():
     # Create DB if not exists
     with app.app_context():
+        new_rollups = not inspect(db.engine).has_table(TrackPlayCount.__tablename__)
         db.create_all()
+        if new_rollups:
+            # First start with statistics: count the history recorded so far
+            rollups.rebuild()
+        # create_all doesn't touch existing tables: add indexes introduced since they were created
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        init_search_index()
+    db_ready.set()
+
+def init_search_index():
+    # Full-text indexes for /search and !history. song_history_fts indexes the titles and
+    # user IDs in song_history without storing a copy of them and is kept in step by
+    # triggers, so the batched inserts of the history writer update it in the same
+    # transaction. upload_fts holds the names of the files in the uploads folder.
+    with db.engine.begin() as connection:
+        schema = connection.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'song_history_fts'"
+        )).scalar()
+        existed = schema is not None and 'user_id' in schema
+        if schema is not None and not existed:
+            # Made before user IDs were indexed: build it again with them
+            connection.execute(text("DROP TABLE song_history_fts"))
+            for trigger in ('insert', 'delete', 'update'):
+                connection.execute(text(f"DROP TRIGGER IF EXISTS song_history_fts_{trigger}"))
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS song_history_fts USING fts5("
+            "title, user_id, content='song_history', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS song_history_fts_insert AFTER INSERT ON song_history BEGIN "
+            "INSERT INTO song_history_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS song_history_fts_delete AFTER DELETE ON song_history BEGIN "
+            "INSERT INTO song_history_fts (song_history_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); END"
+        ))
+        connection.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS song_history_fts_update AFTER UPDATE OF title, user_id ON song_history BEGIN "
+            "INSERT INTO song_history_fts (song_history_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); "
+            "INSERT INTO song_history_fts (rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END"
+        ))
+        if not existed:
+            # First start with (this version of) search: index the history recorded so far
+            connection.execute(text("INSERT INTO song_history_fts (song_history_fts) VALUES ('rebuild')"))
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS upload_fts USING fts5(filename, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+def clear_incoming_uploads():
+    # Temporary files left over from uploads interrupted by a restart. Only safe while no
+    # process is receiving uploads: it would delete a file another worker is writing.
+    incoming = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+    if os.path.isdir(incoming):
+        for name in os.listdir(incoming):
+            os.remove(os.path.join(incoming, name))
+
+def setup_once():
+    # One-time start-up of a multi-process dashboard, before its workers exist
+    # (gunicorn's on_starting hook, see gunicorn_conf.py)
+    init_db()
+    clear_incoming_uploads()
+    with app.app_context():
+        # The workers are forked from this process and must open their own SQLite connections
+        db.engine.dispose()
+
+_upload_lock = None
+
+def start_upload_processor():
+    # Pending uploads are resumed by one dashboard process at a time, or each of gunicorn's
+    # workers would transcode every one of them. The lock is held for the life of the
+    # process; a worker started after the holder exits takes over. Uploads received later
+    # are processed by whichever worker received them.
+    global _upload_lock
+    try:
+        import fcntl
+    except ImportError:
+        # Windows runs the dashboard in a single process (waitress)
+        return upload_processor.resume()
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock = open(os.path.join(app.instance_path, 'upload_processor.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return
+    _upload_lock = lock
+    upload_processor.resume()
+
+def run():
+    # Flask's development server. Used when the dashboard is embedded in the bot process;
+    # production deployments run wsgi.py instead (WEB_MODE=external)
+    init_db()
+    clear_incoming_uploads()
+    upload_processor.resume()
     
     port = int(os.environ.get("PORT", 8080))
     app.run(host='0.0.0.0', port=port)
-
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
@@ -0,0 +1,40 @@
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+from web_app import app, setup_once, start_upload_processor
+import gunicorn_conf
+
+# Standalone entry point for the dashboard, served by a multi-worker WSGI server instead
+# of Flask's development server inside the bot. It must run on the same host as the bot:
+# they share the SQLite database and the uploads folder. Either point gunicorn at it with
+# the settings that run the one-time start-up in the master process:
+#     gunicorn -c gunicorn_conf.py wsgi:app
+# or run `python wsgi.py`, which picks gunicorn (or waitress on Windows).
+SETTINGS = ('bind', 'workers', 'threads', 'on_starting', 'post_worker_init')
+
+def serve():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn doesn't run on Windows; waitress is single-process but multi-threaded
+        from waitress import serve as waitress_serve
+        setup_once()
+        start_upload_processor()
+        host, port = gunicorn_conf.bind.rsplit(':', 1)
+        waitress_serve(app, host=host, port=int(port), threads=gunicorn_conf.workers * gunicorn_conf.threads)
+        return
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            for name in SETTINGS:
+                self.cfg.set(name, getattr(gunicorn_conf, name))
+
+        def load(self):
+            return app
+
+    StandaloneApplication().run()
+
+if __name__ == '__main__':
+    serve()